@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import base64
-import bcrypt
+import gzip
 import hashlib
 try:
     import config
@@ -10,8 +10,14 @@ except ModuleNotFoundError:
 import json
 import re
 import requests
+import tempfile
+import oggindex
+import passwords
+import previews
 import schema
+import scoredb
 import os
+import threading
 import time
 
 # -- カスタム --
@@ -21,20 +27,26 @@ import pathlib
 from pathlib import Path
 import shutil
 from flask_limiter import Limiter
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+import click
 import flask
 import nkf
 import tjaf
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 # ----
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from flask import Flask, g, jsonify, render_template, request, abort, redirect, session, flash, make_response, send_from_directory
 from flask_caching import Cache
 from flask_session import Session
 from flask_wtf.csrf import CSRFProtect, generate_csrf, CSRFError
-from ffmpy import FFmpeg
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from redis import Redis
 
 def take_config(name, required=False):
@@ -70,7 +82,26 @@ limiter = Limiter(
     strategy="fixed-window", # or "moving-window"
 )
 
-client = MongoClient(host=os.environ.get("TAIKO_WEB_MONGO_HOST") or take_config('MONGO', required=True)['host'])
+class QueryCounter(monitoring.CommandListener):
+    # スレッドごとに MongoDB へのコマンド数を数える
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+    def started(self, event):
+        self.local.count = self.count + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+query_counter = QueryCounter()
+client = MongoClient(host=os.environ.get("TAIKO_WEB_MONGO_HOST") or take_config('MONGO', required=True)['host'], event_listeners=[query_counter])
 basedir = take_config('BASEDIR') or '/'
 
 app.secret_key = take_config('SECRET_KEY') or 'change-me'
@@ -83,7 +114,13 @@ app.config['SESSION_REDIS'] = Redis(
     password=redis_config['CACHE_REDIS_PASSWORD'],
     db=redis_config['CACHE_REDIS_DB']
 )
-app.cache = Cache(app, config=redis_config)
+# CACHE_TYPE が null のときは、カタログやセッションの確認結果などを覚えておけるよう
+# プロセスごとのメモリ上のキャッシュを使う（ワーカー間では共有されない）
+cache_config = dict(redis_config)
+shared_cache = cache_config.get('CACHE_TYPE') not in (None, 'null', 'NullCache')
+if not shared_cache:
+    cache_config['CACHE_TYPE'] = 'simple'
+app.cache = Cache(app, config=cache_config)
 sess = Session()
 sess.init_app(app)
 csrf = CSRFProtect(app)
@@ -91,7 +128,14 @@ csrf = CSRFProtect(app)
 db = client[take_config('MONGO', required=True)['database']]
 db.users.create_index('username', unique=True)
 db.songs.create_index('id', unique=True)
-db.scores.create_index('username')
+score_store = scoredb.create_store(db, take_config('SCORE_STORAGE'))
+score_store.create_indexes()
+# bcrypt の計算は別プロセスで行い、混雑時はすぐに server_busy を返す
+password_hasher = passwords.PasswordHasher(**(take_config('PASSWORD_HASHING') or {}))
+# プレビューはリクエストの中では作らず、裏のキューで作る
+preview_queue = previews.PreviewQueue('public/songs', take_config('PREVIEW_TYPE') or 'mp3', take_config('PREVIEW_WORKERS') or 2)
+db.songs.create_index('catalog_version')
+db.catalog_removed.create_index('id', unique=True)
 
 
 class HashException(Exception):
@@ -102,8 +146,135 @@ def api_error(message):
     return jsonify({'status': 'error', 'message': message})
 
 
+# /api/songs の中身（シリアライズ済み）はバージョンごとのキーに置く
+CATALOG_CACHE_KEY = 'catalog'
+CATALOG_VERSION_KEY = 'catalog_version'
+# 曲の編集時にはバージョンが変わるので、この時間はツールで直接 DB を書き換えた場合の保険
+CATALOG_TIMEOUT = 300
+# 書き込みと読み込みが重なって古いバージョンが残っても、この秒数で読み直す
+CATALOG_VERSION_TIMEOUT = 15
+
+
+def join_songs(songs):
+    # 作者・カテゴリー・スキンを先に全部読み込み、曲とはメモリ上で結合する
+    makers = {x['id']: x for x in db.makers.find({}, {'_id': False})}
+    categories = {x['id']: x['title'] for x in db.categories.find({}, {'_id': False, 'id': True, 'title': True})}
+    song_skins = {}
+    for skin in db.song_skins.find({}, {'_id': False}):
+        song_skins[skin.pop('id')] = skin
+
+    for song in songs:
+        maker_id = song.pop('maker_id', None)
+        song['maker'] = makers.get(maker_id) if maker_id else None
+
+        category_id = song.get('category_id')
+        song['category'] = categories.get(category_id) if category_id else None
+
+        skin_id = song.pop('skin_id', None)
+        song['song_skin'] = song_skins.get(skin_id) if skin_id else None
+    return songs
+
+
+def build_catalog():
+    songs = list(db.songs.find({'enabled': True}, {'_id': False, 'enabled': False, 'catalog_version': False}))
+    return flask.json.dumps(join_songs(songs)).encode('utf-8')
+
+
+def build_catalog_delta(since, version):
+    # since より後に追加・変更された曲と、削除・非公開にされた曲の ID
+    songs = []
+    removed = []
+    for song in db.songs.find({'catalog_version': {'$gt': since}}, {'_id': False, 'catalog_version': False}):
+        if song.pop('enabled', False):
+            songs.append(song)
+        else:
+            removed.append(song['id'])
+    changed = set(song['id'] for song in songs)
+    for entry in db.catalog_removed.find({'version': {'$gt': since}}, {'_id': False, 'id': True}):
+        if entry['id'] not in changed:
+            removed.append(entry['id'])
+    return flask.json.dumps({'version': version, 'full': False, 'songs': join_songs(songs), 'removed': removed}).encode('utf-8')
+
+
+def get_catalog_version():
+    version = app.cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        seq = db.seq.find_one({'name': 'catalog'})
+        version = seq['value'] if seq else 0
+        app.cache.set(CATALOG_VERSION_KEY, version, timeout=CATALOG_VERSION_TIMEOUT)
+    return version
+
+
+def bump_catalog(song_id, removed=False):
+    # 曲を書き換えるたびにカタログのバージョンを上げ、その曲に記録する。
+    # 先に次のバージョンを曲に書いてから、バージョンが読んだときのままなら上げる。
+    # 途中で他の書き込みにバージョンを上げられたら、新しい番号で書き直す。
+    # こうすると、あるバージョンの差分を作った後に、それ以下の番号が曲に書かれることはない
+    db.seq.update_one({'name': 'catalog'}, {'$setOnInsert': {'value': 0}}, upsert=True)
+    while True:
+        version = db.seq.find_one({'name': 'catalog'})['value'] + 1
+        if removed:
+            db.catalog_removed.update_one({'id': song_id}, {'$set': {'version': version}}, upsert=True)
+        else:
+            db.songs.update_one({'id': song_id}, {'$set': {'catalog_version': version}})
+        if db.seq.update_one({'name': 'catalog', 'value': version - 1}, {'$set': {'value': version}}).modified_count:
+            break
+    app.cache.set(CATALOG_VERSION_KEY, version, timeout=CATALOG_VERSION_TIMEOUT)
+
+
+# 譜面のハッシュ計算。HTTP の接続は使い回し、難易度ごとのファイルは同時に取りに行く
+hash_session = requests.Session()
+hash_executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix='hash')
+HASH_CHUNK_SIZE = 65536
+# ダウンロードした譜面をメモリに置く上限。超えたら一時ファイルに書く
+HASH_SPOOL_SIZE = 1048576
+HASH_CACHE_TIMEOUT = 86400
+
+
+def chart_path(url):
+    if url.startswith(basedir):
+        url = url[len(basedir):]
+    return os.path.normpath(os.path.join("public", url))
+
+
+def fetch_chart(url, validator=None):
+    # (検証用の値, 中身) を返す。ローカルのファイルは大きさと更新時刻だけを見て、中身は読まない。
+    # HTTP は前回の ETag / Last-Modified で条件付きで取りに行き、変わっていなければ中身は None
+    if not url.startswith("http://") and not url.startswith("https://"):
+        path = chart_path(url)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise HashException("File not found: %s" % (os.path.abspath(path)))
+        return ['file', path, stat.st_size, stat.st_mtime_ns], None
+
+    headers = {}
+    if validator and validator[0] == 'http':
+        if validator[2]:
+            headers['If-None-Match'] = validator[2]
+        if validator[3]:
+            headers['If-Modified-Since'] = validator[3]
+    with hash_session.get(url, headers=headers, stream=True) as resp:
+        if resp.status_code == 304 and headers:
+            return validator, None
+        if resp.status_code != 200:
+            raise HashException('Invalid response from %s (status code %s)' % (resp.url, resp.status_code))
+        body = tempfile.SpooledTemporaryFile(max_size=HASH_SPOOL_SIZE)
+        for chunk in resp.iter_content(HASH_CHUNK_SIZE):
+            body.write(chunk)
+        body.seek(0)
+        return ['http', url, resp.headers.get('ETag'), resp.headers.get('Last-Modified')], body
+
+
+def update_chart_hash(md5, url, body):
+    if body is None:
+        body = open(chart_path(url), "rb")
+    with body:
+        for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+
+
 def generate_hash(id, form):
-    md5 = hashlib.md5()
     if form['type'] == 'tja':
         urls = ['%s%s/main.tja' % (take_config('SONGS_BASEURL', required=True), id)]
     else:
@@ -112,22 +283,53 @@ def generate_hash(id, form):
             if form['course_' + diff]:
                 urls.append('%s%s/%s.osu' % (take_config('SONGS_BASEURL', required=True), id, diff))
 
-    for url in urls:
-        if url.startswith("http://") or url.startswith("https://"):
-            resp = requests.get(url)
-            if resp.status_code != 200:
-                raise HashException('Invalid response from %s (status code %s)' % (resp.url, resp.status_code))
-            md5.update(resp.content)
-        else:
-            if url.startswith(basedir):
-                url = url[len(basedir):]
-            path = os.path.normpath(os.path.join("public", url))
-            if not os.path.isfile(path):
-                raise HashException("File not found: %s" % (os.path.abspath(path)))
-            with open(path, "rb") as file:
-                md5.update(file.read())
+    # 全てのファイルが前回と同じなら、前回のハッシュを返す。ETag も Last-Modified も無い HTTP のファイルは毎回読む
+    key = 'chart_hash:%s' % hashlib.md5(json.dumps(urls).encode('utf-8')).hexdigest()
+    cached = app.cache.get(key)
+    old_validators = cached['validators'] if cached else [None] * len(urls)
+    results = list(hash_executor.map(fetch_chart, urls, old_validators))
+    validators = [result[0] for result in results]
+    if cached and validators == old_validators and all(v[0] == 'file' or v[2] or v[3] for v in validators):
+        for validator, body in results:
+            if body is not None:
+                body.close()
+        return cached['hash']
+
+    # 変わっていなかった HTTP のファイルは、条件なしで取り直す
+    refetch = [i for i, (validator, body) in enumerate(results) if validator[0] == 'http' and body is None]
+    for i, result in zip(refetch, hash_executor.map(fetch_chart, [urls[i] for i in refetch])):
+        results[i] = result
 
-    return base64.b64encode(md5.digest())[:-2].decode('utf-8')
+    md5 = hashlib.md5()
+    for url, (validator, body) in zip(urls, results):
+        update_chart_hash(md5, url, body)
+    chart_hash = base64.b64encode(md5.digest())[:-2].decode('utf-8')
+    app.cache.set(key, {'validators': validators, 'hash': chart_hash}, timeout=HASH_CACHE_TIMEOUT)
+    return chart_hash
+
+
+# リクエスト中の現在のユーザーとして読み込むフィールド。パスワードは確認する処理が自分で読む
+USER_FIELDS = {
+    '_id': False,
+    'username': True,
+    'display_name': True,
+    'user_level': True,
+    'session_id': True,
+    'don_body_fill': True,
+    'don_face_fill': True,
+    'rank_name': True,
+    'rank_color': True,
+    'score_version': True,
+    'score_reset': True
+}
+
+
+def current_user():
+    # 最初に使われたときに一度だけ読み込み、同じリクエストの中で使い回す
+    if 'user' not in g:
+        username = session.get('username')
+        g.user = db.users.find_one({'username': username}, USER_FIELDS) if username else None
+    return g.user
 
 
 def login_required(f):
@@ -143,11 +345,8 @@ def admin_required(level):
     def decorated_function(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            if not session.get('username'):
-                return abort(403)
-            
-            user = db.users.find_one({'username': session.get('username')})
-            if user['user_level'] < level:
+            user = current_user()
+            if not user or user['user_level'] < level:
                 return abort(403)
 
             return f(*args, **kwargs)
@@ -160,13 +359,57 @@ def handle_csrf_error(e):
     return api_error('invalid_csrf')
 
 
+@app.errorhandler(passwords.PasswordBusy)
+def handle_password_busy(e):
+    response = api_error('server_busy')
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+# 有効と確認したセッションを覚えておく秒数。パスワード変更・アカウント削除では明示的に消す。
+# プロセスごとのキャッシュでは他のワーカーの分を消せないので、短くしておく
+SESSION_CACHE_TIMEOUT = 60
+SESSION_LOCAL_CACHE_TIMEOUT = 5
+# 静的ファイルはセッションを確認しない
+STATIC_ENDPOINTS = ('static', 'send_src', 'send_assets', 'send_songs', 'send_manifest', 'send_upload')
+
+
+def session_valid(session_id):
+    key = 'session:%s' % session_id
+    if app.cache.get(key):
+        return True
+    if db.users.find_one({'session_id': session_id}, {'_id': True}):
+        app.cache.set(key, True, timeout=SESSION_CACHE_TIMEOUT if shared_cache else SESSION_LOCAL_CACHE_TIMEOUT)
+        return True
+    return False
+
+
+def evict_session(session_id):
+    app.cache.delete('session:%s' % session_id)
+
+
 @app.before_request
 def before_request_func():
+    g.queries = query_counter.count
+    password_hasher.local.wait = None
+    if request.endpoint in STATIC_ENDPOINTS:
+        return
     if session.get('session_id'):
-        if not db.users.find_one({'session_id': session.get('session_id')}):
+        if not session_valid(session.get('session_id')):
             session.clear()
 
 
+@app.after_request
+def after_request_func(response):
+    if app.debug and 'queries' in g:
+        # このリクエストで MongoDB に問い合わせた回数
+        response.headers['X-DB-Queries'] = str(query_counter.count - g.queries)
+        if getattr(password_hasher.local, 'wait', None) is not None:
+            # パスワードの計算がプロセスプールで待たされた時間
+            response.headers['X-Password-Wait'] = '%.1fms' % (password_hasher.local.wait * 1000)
+    return response
+
+
 def get_config(credentials=False):
     config_out = {
         'basedir': basedir,
@@ -186,11 +429,8 @@ def get_config(credentials=False):
     if credentials:
         google_credentials = take_config('GOOGLE_CREDENTIALS')
         min_level = google_credentials['min_level'] or 0
-        if not session.get('username'):
-            user_level = 0
-        else:
-            user = db.users.find_one({'username': session.get('username')})
-            user_level = user['user_level']
+        user = current_user()
+        user_level = user['user_level'] if user else 0
         if user_level >= min_level:
             config_out['google_credentials'] = google_credentials
         else:
@@ -284,7 +524,7 @@ def route_admin():
 def route_admin_songs():
     songs = sorted(list(db.songs.find({})), key=lambda x: x['id'])
     categories = db.categories.find({})
-    user = db.users.find_one({'username': session['username']})
+    user = current_user()
     return render_template('admin_songs.html', songs=songs, admin=user, categories=list(categories), config=get_config())
 
 
@@ -298,7 +538,7 @@ def route_admin_songs_id(id):
     categories = list(db.categories.find({}))
     song_skins = list(db.song_skins.find({}))
     makers = list(db.makers.find({}))
-    user = db.users.find_one({'username': session['username']})
+    user = current_user()
 
     return render_template('admin_song_detail.html',
         song=song, categories=categories, song_skins=song_skins, makers=makers, admin=user, config=get_config())
@@ -384,6 +624,7 @@ def route_admin_songs_new_post():
         file_music.save(target_dir / f"main.{ext}")
 
     db.songs.insert_one(output)
+    bump_catalog(seq_new)
     if not hash_error:
         flash('Song created.')
 
@@ -398,7 +639,7 @@ def route_admin_songs_id_post(id):
     if not song:
         return abort(404)
 
-    user = db.users.find_one({'username': session['username']})
+    user = current_user()
     user_level = user['user_level']
 
     output = {'title_lang': {}, 'subtitle_lang': {}, 'courses': {}}
@@ -440,50 +681,51 @@ def route_admin_songs_id_post(id):
             flash('An error occurred: %s' % str(e), 'error')
     
     db.songs.update_one({'id': id}, {'$set': output})
+    bump_catalog(id)
     if not hash_error:
         flash('Changes saved.')
     
     return redirect(basedir + 'admin/songs/%s' % id)
 
-    @app.route(basedir + 'admin/songs/<int:id>/delete', methods=['POST'])
-    @admin_required(level=100)
-    def route_admin_songs_id_delete(id):
-        song = db.songs.find_one({'id': id})
-        if not song:
-            return abort(404)
 
-        db.songs.delete_one({'id': id})
+@app.route(basedir + 'admin/songs/<int:id>/delete', methods=['POST'])
+@admin_required(level=100)
+def route_admin_songs_id_delete(id):
+    song = db.songs.find_one({'id': id})
+    if not song:
+        return abort(404)
 
-        song_dir = Path('public/songs') / str(id)
-        if song_dir.exists() and song_dir.is_dir():
-            shutil.rmtree(song_dir)
+    db.songs.delete_one({'id': id})
+    bump_catalog(id, removed=True)
 
-        last_song = db.songs.find_one(sort=[('id', -1)])
-        new_seq_value = last_song['id'] if last_song else 0
+    song_dir = Path('public/songs') / str(id)
+    if song_dir.exists() and song_dir.is_dir():
+        shutil.rmtree(song_dir)
 
-        db.seq.update_one(
-            {'name': 'songs'},
-            {'$set': {'value': new_seq_value}},
-            upsert=True
-        )
+    last_song = db.songs.find_one(sort=[('id', -1)])
+    new_seq_value = last_song['id'] if last_song else 0
 
-        flash('Song deleted.')
-        return redirect(basedir + 'admin/songs')
+    db.seq.update_one(
+        {'name': 'songs'},
+        {'$set': {'value': new_seq_value}},
+        upsert=True
+    )
+
+    flash('Song deleted.')
+    return redirect(basedir + 'admin/songs')
 
 
 @app.route(basedir + 'admin/users')
 @admin_required(level=50)
 def route_admin_users():
-    user = db.users.find_one({'username': session.get('username')})
-    max_level = user['user_level'] - 1
+    max_level = current_user()['user_level'] - 1
     return render_template('admin_users.html', config=get_config(), max_level=max_level, username='', level='')
 
 
 @app.route(basedir + 'admin/users', methods=['POST'])
 @admin_required(level=50)
 def route_admin_users_post():
-    admin_name = session.get('username')
-    admin = db.users.find_one({'username': admin_name})
+    admin = current_user()
     max_level = admin['user_level'] - 1
     
     username = request.form.get('username')
@@ -492,7 +734,7 @@ def route_admin_users_post():
     except ValueError:
         level = 0
     
-    user = db.users.find_one({'username_lower': username.lower()})
+    user = db.users.find_one({'username_lower': username.lower()}, {'_id': False, 'username': True, 'user_level': True})
     if not user:
         flash('Error: User was not found.')
     elif admin['username'] == user['username']:
@@ -512,53 +754,71 @@ def route_admin_users_post():
 
 
 @app.route(basedir + 'api/preview')
-@app.cache.cached(timeout=15, query_string=True)
+@app.cache.cached(timeout=15, query_string=True, response_filter=lambda response: not response.is_streamed)
 def route_api_preview():
     song_id = request.args.get('id', None)
     if not song_id or not re.match('^[0-9]{1,9}$', song_id):
         abort(400)
 
     song_id = int(song_id)
-    song = db.songs.find_one({'id': song_id})
+    song = db.songs.find_one({'id': song_id}, {'_id': False, 'music_type': True, 'preview': True})
     if not song:
         abort(400)
 
-    song_type = song['type']
-    song_ext = song['music_type'] if song['music_type'] else "mp3"
-    prev_path = make_preview(song_id, song_type, song_ext, song['preview'])
-    if not prev_path:
-        return redirect(get_config()['songs_baseurl'] + '%s/main.%s' % (song_id, song_ext))
+    song_ext = song.get('music_type') or "mp3"
+    if preview_queue.ready(song_id):
+        return redirect(get_config()['songs_baseurl'] + '%s/preview.%s' % (song_id, preview_queue.ext))
 
-    return redirect(get_config()['songs_baseurl'] + '%s/preview.mp3' % song_id)
+    if song.get('preview') and song['preview'] > 0:
+        if song_ext == 'ogg':
+            # Ogg は変換せず、プレビューの位置のページから先をそのまま返す
+            try:
+                return ogg_preview(os.path.join(preview_queue.song_dir, str(song_id), 'main.ogg'), song['preview'])
+            except (OSError, ValueError) as e:
+                print('Cannot slice song #%s:' % song_id, e)
+        # できるまでは元の曲を返す
+        preview_queue.request(song_id, song_ext, song['preview'])
+    return redirect(get_config()['songs_baseurl'] + '%s/main.%s' % (song_id, song_ext))
 
 
-@app.route(basedir + 'api/songs')
-@app.cache.cached(timeout=15)
-def route_api_songs():
-    songs = list(db.songs.find({'enabled': True}, {'_id': False, 'enabled': False}))
-    for song in songs:
-        if song['maker_id']:
-            if song['maker_id'] == 0:
-                song['maker'] = 0
-            else:
-                song['maker'] = db.makers.find_one({'id': song['maker_id']}, {'_id': False})
-        else:
-            song['maker'] = None
-        del song['maker_id']
+def ogg_preview(path, seconds):
+    # 曲の最後までではなく PREVIEW_LENGTH 秒分だけ返す
+    index = oggindex.get_index(path)
+    response = flask.Response(oggindex.iter_slice(index, seconds, previews.PREVIEW_LENGTH), mimetype='audio/ogg')
+    response.headers['Content-Length'] = str(index.slice_size(seconds, previews.PREVIEW_LENGTH))
+    return cache_wrap(response, 3600)
 
-        if song['category_id']:
-            song['category'] = db.categories.find_one({'id': song['category_id']})['title']
-        else:
-            song['category'] = None
-        #del song['category_id']
 
-        if song['skin_id']:
-            song['song_skin'] = db.song_skins.find_one({'id': song['skin_id']}, {'_id': False, 'id': False})
-        else:
-            song['song_skin'] = None
-        del song['skin_id']
+@app.route(basedir + 'api/songs')
+def route_api_songs():
+    since = request.args.get('since', None)
+    if since is not None and not re.match('^[0-9]{1,9}$', since):
+        abort(400)
 
-    return cache_wrap(flask.jsonify(songs), 60)
+    version = get_catalog_version()
+    if since is not None and 0 < int(since) <= version:
+        # 差分だけを返す
+        key = '%s:%s:%s' % (CATALOG_CACHE_KEY, since, version)
+        body = app.cache.get(key)
+        if body is None:
+            body = build_catalog_delta(int(since), version)
+            app.cache.set(key, body, timeout=CATALOG_TIMEOUT)
+    else:
+        key = '%s:%s' % (CATALOG_CACHE_KEY, version)
+        body = app.cache.get(key)
+        if body is None:
+            queries = query_counter.count
+            body = build_catalog()
+            app.cache.set(key, body, timeout=CATALOG_TIMEOUT)
+            print('Built song catalog: %s bytes, %s queries' % (len(body), query_counter.count - queries))
+        if since is not None:
+            # 手元のバージョンが無い・合わない場合は全曲を差分の形で返す
+            body = b'{"version":%d,"full":true,"removed":[],"songs":%s}' % (version, body)
+
+    response = flask.Response(body, mimetype='application/json')
+    response.headers['X-Catalog-Version'] = str(version)
+    response.set_etag('catalog-%s' % version)
+    return cache_wrap(response.make_conditional(request), 60)
 
 @app.route(basedir + 'api/categories')
 @app.cache.cached(timeout=15)
@@ -586,15 +846,14 @@ def route_api_register():
     if len(username) < 3 or len(username) > 20 or not re.match('^[a-zA-Z0-9_]{3,20}$', username):
         return api_error('invalid_username')
 
-    if db.users.find_one({'username_lower': username.lower()}):
+    if db.users.find_one({'username_lower': username.lower()}, {'_id': True}):
         return api_error('username_in_use')
 
     password = data.get('password', '').encode('utf-8')
     if not 6 <= len(password) <= 5000:
         return api_error('invalid_password')
 
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password, salt)
+    hashed = password_hasher.hash(password)
     don = get_default_don()
     rank = get_default_rank()
     
@@ -631,8 +890,14 @@ def route_api_login():
         return api_error('invalid_username_password')
 
     password = data.get('password', '').encode('utf-8')
-    if not bcrypt.checkpw(password, result['password']):
+    if not password_hasher.check(password, result['password']):
         return api_error('invalid_username_password')
+    if password_hasher.needs_rehash(result['password']):
+        # コストの設定が変わっていたら、ログインの機会に作り直す。混雑時は次の機会に回す
+        try:
+            db.users.update_one({'username': result['username']}, {'$set': {'password': password_hasher.hash(password)}})
+        except passwords.PasswordBusy:
+            pass
     
     don = get_db_don(result)
     rank = get_db_rank(result)
@@ -727,22 +992,22 @@ def route_api_account_password():
     if not schema.validate(data, schema.update_password):
         return abort(400)
 
-    user = db.users.find_one({'username': session.get('username')})
+    user = db.users.find_one({'username': session.get('username')}, {'_id': False, 'password': True, 'session_id': True})
     current_password = data.get('current_password', '').encode('utf-8')
-    if not bcrypt.checkpw(current_password, user['password']):
+    if not password_hasher.check(current_password, user['password']):
         return api_error('current_password_invalid')
     
     new_password = data.get('new_password', '').encode('utf-8')
     if not 6 <= len(new_password) <= 5000:
         return api_error('invalid_new_password')
     
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(new_password, salt)
+    hashed = password_hasher.hash(new_password)
     session_id = os.urandom(24).hex()
 
     db.users.update_one({'username': session.get('username')}, {
         '$set': {'password': hashed, 'session_id': session_id}
     })
+    evict_session(user['session_id'])
 
     session['session_id'] = session_id
     return jsonify({'status': 'ok'})
@@ -756,13 +1021,14 @@ def route_api_account_remove():
     if not schema.validate(data, schema.delete_account):
         return abort(400)
 
-    user = db.users.find_one({'username': session.get('username')})
+    user = db.users.find_one({'username': session.get('username')}, {'_id': False, 'password': True, 'session_id': True})
     password = data.get('password', '').encode('utf-8')
-    if not bcrypt.checkpw(password, user['password']):
+    if not password_hasher.check(password, user['password']):
         return api_error('verify_password_invalid')
 
-    db.scores.delete_many({'username': session.get('username')})
+    score_store.remove(session.get('username'))
     db.users.delete_one({'username': session.get('username')})
+    evict_session(user['session_id'])
 
     session.clear()
     return jsonify({'status': 'ok'})
@@ -776,17 +1042,7 @@ def route_api_scores_save():
         return abort(400)
 
     username = session.get('username')
-    if data.get('is_import'):
-        db.scores.delete_many({'username': username})
-
-    scores = data.get('scores', [])
-    for score in scores:
-        db.scores.update_one({'username': username, 'hash': score['hash']},
-        {'$set': {
-            'username': username,
-            'hash': score['hash'],
-            'score': score['score']
-        }}, upsert=True)
+    score_store.save(username, data.get('scores', []), replace=data.get('is_import'))
 
     return jsonify({'status': 'ok'})
 
@@ -794,19 +1050,30 @@ def route_api_scores_save():
 @app.route(basedir + 'api/scores/get')
 @login_required
 def route_api_scores_get():
-    username = session.get('username')
-
-    scores = []
-    for score in db.scores.find({'username': username}):
-        scores.append({
-            'hash': score['hash'],
-            'score': score['score']
-        })
+    since = request.args.get('since', None)
+    if since is not None and not re.match('^[0-9]{1,9}$', since):
+        abort(400)
 
-    user = db.users.find_one({'username': username})
+    user = current_user()
     don = get_db_don(user)
     rank = get_db_rank(user)
-    return jsonify({'status': 'ok', 'scores': scores, 'username': user['username'], 'display_name': user['display_name'], 'don': don, 'rank': rank})
+    # 同期トークンはスコアのバージョン。インポートで置き換えられていたら全件を返す
+    version = user.get('score_version', 0)
+    full = since is None or int(since) < user.get('score_reset', 0) or int(since) > version
+
+    etag = hashlib.md5(json.dumps([user['username'], version, None if full else since, user['display_name'], don, rank]).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        scores = score_store.load(user['username'], 0 if full else int(since))
+        response = compress_response(json.dumps({
+            'status': 'ok', 'scores': scores, 'full': full, 'sync': str(version),
+            'username': user['username'], 'display_name': user['display_name'], 'don': don, 'rank': rank
+        }).encode('utf-8'))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
 
 
 @app.route(basedir + 'privacy')
@@ -819,21 +1086,27 @@ def route_api_privacy():
     return response
 
 
-def make_preview(song_id, song_type, song_ext, preview):
-    song_path = 'public/songs/%s/main.%s' % (song_id, song_ext)
-    prev_path = 'public/songs/%s/preview.mp3' % song_id
-
-    if os.path.isfile(song_path) and not os.path.isfile(prev_path):
-        if not preview or preview <= 0:
-            print('Skipping #%s due to no preview' % song_id)
-            return False
+@app.cli.command('warm-previews', help='Make missing previews for every enabled song.')
+@click.option('--jobs', type=int, default=os.cpu_count() or 1, help='ffmpeg processes to run at once.')
+def warm_previews(jobs):
+    queue = previews.PreviewQueue(preview_queue.song_dir, preview_queue.ext, jobs)
+    futures = []
+    for song in db.songs.find({'enabled': True}, {'_id': False, 'id': True, 'music_type': True, 'preview': True}):
+        if song.get('preview') and song['preview'] > 0 and not queue.ready(song['id']):
+            futures.append(queue.request(song['id'], song.get('music_type') or 'mp3', song['preview']))
 
-        print('Making preview.mp3 for song #%s' % song_id)
-        ff = FFmpeg(inputs={song_path: '-ss %s' % preview},
-                    outputs={prev_path: '-codec:a libmp3lame -ar 32000 -b:a 92k -y -loglevel panic'})
-        ff.run()
-
-    return prev_path
+    start = time.time()
+    made = 0
+    failed = 0
+    for i, future in enumerate(futures):
+        try:
+            if future.result():
+                made += 1
+        except Exception:
+            failed += 1
+        if (i + 1) % 50 == 0:
+            print('%s/%s' % (i + 1, len(futures)))
+    print('Made %s previews (%s skipped, %s failed) in %.1f s' % (made, len(futures) - made - failed, failed, time.time() - start))
 
 error_pages = take_config('ERROR_PAGES') or {}
 
@@ -853,6 +1126,20 @@ for code in error_pages:
     if error_pages[code]:
         create_error_page(code, error_pages[code])
 
+def compress_response(body, mimetype='application/json'):
+    # 1KB を超える本文はクライアントが受け付ける形式で圧縮して返す
+    response = flask.Response(body, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if len(body) > 1024:
+        encodings = request.accept_encodings
+        if brotli is not None and 'br' in encodings:
+            response.set_data(brotli.compress(body, quality=5))
+            response.headers['Content-Encoding'] = 'br'
+        elif 'gzip' in encodings:
+            response.set_data(gzip.compress(body, 6))
+            response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 def cache_wrap(res_from, secs):
     res = flask.make_response(res_from)
     res.headers["Cache-Control"] = f"public, max-age={secs}, s-maxage={secs}"
@@ -880,8 +1167,106 @@ def send_manifest():
 def send_upload(ref):
     return cache_wrap(flask.send_from_directory("public/upload", ref), 3600)
 
+# アップロードを置く場所と、ファイルごとの上限（バイト）
+SONGS_DIR = os.getenv("TAIKO_WEB_SONGS_DIR", "public/songs")
+UPLOAD_LIMITS = {'tja': 2 * 1024 * 1024, 'music': 50 * 1024 * 1024}
+UPLOAD_LIMITS.update(take_config('UPLOAD_LIMITS') or {})
+# multipart の区切りやフォームの項目の分
+UPLOAD_OVERHEAD = 64 * 1024
+# 受け取り中のファイルを置く場所。公開されない、曲のディレクトリと同じファイルシステム上の場所
+# （既定では曲のディレクトリと並べる）にして、最後は名前を変えるだけで済ませる
+UPLOAD_TMP_DIR = os.getenv("TAIKO_WEB_UPLOAD_TMP_DIR") or os.path.join(os.path.dirname(os.path.abspath(SONGS_DIR)), '.uploads')
+# プロセスが落ちて残った一時ファイルは、これより古ければ起動時に消す（秒）
+UPLOAD_STALE_AFTER = 3600
+
+
+def sweep_uploads():
+    try:
+        names = os.listdir(UPLOAD_TMP_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(UPLOAD_TMP_DIR, name)
+        try:
+            if name.startswith('.upload-') and time.time() - os.path.getmtime(path) > UPLOAD_STALE_AFTER:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+sweep_uploads()
+
+
+class UploadFile:
+    # 受け取りながら SHA-256 を計算して、UPLOAD_TMP_DIR の一時ファイルに書く
+    def __init__(self, directory, limit):
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='.upload-', delete=False)
+        self.path = self.file.name
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge()
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def remove(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRequest(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # /api/upload のファイルはメモリや別の一時ファイルを通さずに直接書く
+        # （CSRF の確認でフォームが先に読まれることもあるので、ここで上限も確かめる）
+        if self.endpoint != 'upload_file':
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if total_content_length is None or total_content_length > sum(UPLOAD_LIMITS.values()) + UPLOAD_OVERHEAD:
+            raise RequestEntityTooLarge()
+        if 'uploads' not in g:
+            # 途中で接続が切れたときなどに残ったものは remove_uploads で消す
+            g.uploads = []
+            g.upload_started = time.perf_counter()
+        kind = 'tja' if (filename or '').lower().endswith('.tja') else 'music'
+        os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+        upload = UploadFile(UPLOAD_TMP_DIR, UPLOAD_LIMITS[kind])
+        g.uploads.append(upload)
+        return upload
+
+
+app.request_class = UploadRequest
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    return flask.jsonify({'error': 'ファイルが大きすぎます'}), 413
+
+
+@app.teardown_request
+def remove_uploads(e=None):
+    # 曲のディレクトリに移さなかった一時ファイル（エラーや上限超えで残ったもの）を消す
+    for upload in g.pop('uploads', []):
+        upload.remove()
+
+
 @app.route("/api/upload", methods=["POST"])
 def upload_file():
+    # ファイルを受け取る前に Content-Length で断る
+    if request.content_length is not None and request.content_length > sum(UPLOAD_LIMITS.values()) + UPLOAD_OVERHEAD:
+        raise RequestEntityTooLarge()
+    staging_dir = None
     try:
         # POSTリクエストにファイルの部分がない場合
         if 'file_tja' not in flask.request.files or 'file_music' not in flask.request.files:
@@ -893,8 +1278,11 @@ def upload_file():
         # ファイルが選択されておらず空のファイルを受け取った場合
         if file_tja.filename == '' or file_music.filename == '':
             return flask.jsonify({'error': 'ファイルが選択されていません'})
+        # 拡張子が .tja でない TJA は曲の上限で受け取っているので、ここで確かめる
+        if file_tja.stream.size > UPLOAD_LIMITS['tja']:
+            raise RequestEntityTooLarge()
 
-        # TJAファイルをテキストUTF-8/LFに変換
+        # TJAファイルをテキストUTF-8/LFに変換（上限があるのでメモリに読む）
         tja_data = nkf.nkf('-wd', file_tja.read())
         tja_text = tja_data.decode("utf-8")
         print("TJAのサイズ:",len(tja_text))
@@ -905,11 +1293,9 @@ def upload_file():
         msg.update(tja_data)
         tja_hash = msg.hexdigest()
         print("TJA:",tja_hash)
-        # 音楽ファイルのハッシュ値を生成
-        music_data = file_music.read()
-        msg2 = hashlib.sha256()
-        msg2.update(music_data)
-        music_hash = msg2.hexdigest()
+        # 音楽ファイルのハッシュ値は受け取りながら計算済み
+        music = file_music.stream
+        music_hash = music.sha256.hexdigest()
         print("音楽:",music_hash)
         # IDを生成
         generated_id = f"{tja_hash}-{music_hash}"
@@ -917,20 +1303,44 @@ def upload_file():
         db_entry = tja.to_mongo(generated_id, time.time_ns())
         pprint.pprint(db_entry)
 
-        # mongoDBにデータをぶち込む
-        client['taiko']["songs"].insert_one(db_entry)
+        # 曲のディレクトリを一時的な名前で用意する
+        # （mkdtemp と NamedTemporaryFile は本人しか読めないので、公開する前に権限を戻す）
+        staging_dir = tempfile.mkdtemp(dir=UPLOAD_TMP_DIR, prefix='.upload-')
+        os.chmod(staging_dir, 0o755)
+        # TJAを保存
+        (pathlib.Path(staging_dir) / "main.tja").write_bytes(tja_data)
+        # 曲ファイルは一時ファイルを移すだけ
+        music.close()
+        os.chmod(music.path, 0o644)
+        os.replace(music.path, os.path.join(staging_dir, f"main.{db_entry['music_type']}"))
 
-        # ディレクトリを作成
-        target_dir = pathlib.Path(os.getenv("TAIKO_WEB_SONGS_DIR", "public/songs")) / generated_id
-        target_dir.mkdir(parents=True,exist_ok=True)
+        # mongoDBにデータをぶち込む
+        inserted = client['taiko']["songs"].insert_one(db_entry)
 
-        # TJAを保存
-        (target_dir / "main.tja").write_bytes(tja_data)
-        # 曲ファイルも保存
-        (target_dir / f"main.{db_entry['music_type']}").write_bytes(music_data)
+        # 登録できたらディレクトリごと名前を変えて公開する（途中のファイルが見えることはない）
+        target_dir = os.path.join(SONGS_DIR, generated_id)
+        try:
+            os.makedirs(SONGS_DIR, exist_ok=True)
+            os.rename(staging_dir, target_dir)
+        except OSError:
+            # 入れたものだけを消す
+            client['taiko']["songs"].delete_one({'_id': inserted.inserted_id})
+            raise
+        staging_dir = None
+        bump_catalog(generated_id)
+
+        # メモリの使い方は tools/bench_upload.py でプロセスの外から測る
+        print('アップロード: %s 音楽 %.1fMiB TJA %.1fKiB %.2f秒' % (
+            generated_id, music.size / 1048576, file_tja.stream.size / 1024,
+            time.perf_counter() - g.upload_started))
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         error_str = ''.join(traceback.TracebackException.from_exception(e).format())
         return flask.jsonify({'error': error_str})
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
     return flask.jsonify({'success': True})
 
@@ -939,6 +1349,7 @@ def upload_file():
 def delete():
     id = flask.request.get_json().get('id')
     client["taiko"]["songs"].delete_one({ "id": id })
+    bump_catalog(id, removed=True)
 
     parent_dir = pathlib.Path(os.getenv("TAIKO_WEB_SONGS_DIR", "public/songs"))
     target_dir = parent_dir / id
@@ -0,0 +1,338 @@
+import os
+import socket
+import asyncio
+import traceback
+from collections import deque
+from urllib.parse import urlparse, unquote
+
+# ================================
+# マルチプレイ用バックプレーン
+# ワーカー間でメッセージを中継し、waiting / invites の登録簿を共有する
+# メッセージは "<op> <key> <payload>" の文字列で、payload は中身を見ずにそのまま運ぶ
+# ================================
+
+# 候補の key（ARGV[3] 以降、先頭から優先）のどれかが登録簿にあれば取り出して返し、
+# なければ自分を ARGV[1] に登録する
+CLAIM_SCRIPT = """
+for i = 3, #ARGV do
+    local v = redis.call('HGET', KEYS[1], ARGV[i])
+    if v then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        return v
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return false
+"""
+
+TAKE_SCRIPT = """
+local v = redis.call('HGET', KEYS[1], ARGV[1])
+if v then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return v
+"""
+
+# 自分が登録したものだけを消す
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# 切断されたら再接続を試みる間隔（秒）。失敗するたびに倍にし、RECONNECT_DELAY_MAX で止める
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 10
+# 返事を待つ上限（秒）。接続が黙って止まっても呼び出し元を待たせ続けない
+COMMAND_TIMEOUT = 5
+
+class BackplaneError(Exception):
+    pass
+
+def new_worker_id():
+    return "%s-%s-%s" % (socket.gethostname(), os.getpid(), os.urandom(3).hex())
+
+def split_message(message):
+    op, key, payload = message.split(" ", 2)
+    return op, key, payload
+
+# ================================
+# プロセス内（テスト・単一ワーカー用）
+# ================================
+class MemoryHub:
+    def __init__(self):
+        self.registries = {}
+        self.workers = {}
+
+class MemoryBackplane:
+    def __init__(self, hub=None):
+        self.hub = hub or MemoryHub()
+        self.worker_id = None
+        self.stats = {"reconnects": 0, "dropped": 0}
+
+    async def start(self, handler):
+        self.worker_id = new_worker_id()
+        self.hub.workers[self.worker_id] = handler
+
+    async def close(self):
+        self.hub.workers.pop(self.worker_id, None)
+
+    def registry(self, name):
+        return self.hub.registries.setdefault(name, {})
+
+    def send(self, worker, op, key, payload=""):
+        handler = self.hub.workers.get(worker)
+        if handler is not None:
+            asyncio.get_running_loop().call_soon(handler, op, str(key), payload)
+
+    def broadcast(self, op, key, payload=""):
+        loop = asyncio.get_running_loop()
+        for handler in list(self.hub.workers.values()):
+            loop.call_soon(handler, op, str(key), payload)
+
+    async def claim(self, name, key, entry, candidates=None):
+        registry = self.registry(name)
+        for candidate in candidates or (key,):
+            other = registry.pop(candidate, None)
+            if other is not None:
+                return other
+        registry[key] = entry
+        return None
+
+    async def reserve(self, name, key, entry):
+        registry = self.registry(name)
+        if key in registry:
+            return False
+        registry[key] = entry
+        return True
+
+    async def take(self, name, key):
+        return self.registry(name).pop(key, None)
+
+    async def release(self, name, key, entry):
+        registry = self.registry(name)
+        if registry.get(key) == entry:
+            del registry[key]
+
+    async def entries(self, name):
+        return dict(self.registry(name))
+
+# ================================
+# Redis プロトコル（TCP または UNIX ソケット）
+# ================================
+def encode_command(args):
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Backplane connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    elif kind == b"-":
+        # パイプライン中なので例外は投げずに返し、呼び出し元の Future に渡す
+        return BackplaneError(rest.decode("utf-8"))
+    elif kind == b":":
+        return int(rest)
+    elif kind == b"$":
+        length = int(rest)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2].decode("utf-8")
+    elif kind == b"*":
+        length = int(rest)
+        if length == -1:
+            return None
+        return [await read_reply(reader) for i in range(length)]
+    raise BackplaneError("Invalid reply from backplane: %r" % line)
+
+class RedisBackplane:
+    def __init__(self, url, prefix="taiko"):
+        self.url = urlparse(url)
+        self.prefix = prefix
+        self.worker_id = None
+        self.handler = None
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.pending = deque()
+        self.tasks = []
+        self.supervisor = None
+        self.scripts = {}
+        self.stats = {"reconnects": 0, "dropped": 0}
+
+    def channel(self, worker):
+        return "%s:worker:%s" % (self.prefix, worker)
+
+    def key(self, name):
+        return "%s:%s" % (self.prefix, name)
+
+    async def connect(self):
+        url = self.url
+        if url.scheme == "unix":
+            reader, writer = await asyncio.open_unix_connection(unquote(url.path))
+        else:
+            reader, writer = await asyncio.open_connection(url.hostname or "127.0.0.1", url.port or 6379)
+        handshake = []
+        if url.password:
+            handshake.append(("AUTH", unquote(url.password)))
+        db = url.path.strip("/") if url.scheme != "unix" else ""
+        if db:
+            handshake.append(("SELECT", db))
+        for args in handshake:
+            writer.write(encode_command(args))
+            reply = await read_reply(reader)
+            if isinstance(reply, BackplaneError):
+                raise reply
+        return reader, writer
+
+    async def start(self, handler):
+        self.worker_id = new_worker_id()
+        self.handler = handler
+        # 最初の接続に失敗したときは起動を失敗させる。その後の切断は supervise() がつなぎ直す
+        await self.open()
+        self.supervisor = asyncio.ensure_future(self.supervise())
+        self.supervisor.add_done_callback(self.supervisor_done)
+
+    async def open(self):
+        # コマンド用と Pub/Sub 用（専用の接続が必要）の2本をつなぎ、スクリプトを読み込んで購読する
+        self.reader, self.writer = await self.connect()
+        self.pending = deque()
+        self.connected = True
+        self.tasks = [asyncio.ensure_future(self.read_replies(self.reader))]
+        try:
+            for name, script in (("claim", CLAIM_SCRIPT), ("take", TAKE_SCRIPT), ("release", RELEASE_SCRIPT)):
+                self.scripts[name] = await self.call("SCRIPT", "LOAD", script)
+            sub_reader, sub_writer = await self.connect()
+        except BaseException as e:
+            self.disconnect(ConnectionError("Backplane connection failed: %s" % e))
+            raise
+        sub_writer.write(encode_command(("SUBSCRIBE", self.channel(self.worker_id), self.channel("*"))))
+        self.tasks.append(asyncio.ensure_future(self.read_messages(sub_reader, sub_writer, self.handler)))
+
+    async def supervise(self):
+        while True:
+            done, pending = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
+            task = done.pop()
+            error = None if task.cancelled() else task.exception()
+            print("Backplane connection lost:", error or "closed")
+            self.disconnect(ConnectionError("Backplane connection lost"))
+            delay = RECONNECT_DELAY
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self.open()
+                except (OSError, EOFError, BackplaneError) as e:
+                    print("Backplane reconnect failed:", e)
+                    delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                    continue
+                break
+            self.stats["reconnects"] += 1
+            print("Backplane reconnected")
+
+    def supervisor_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            print("Backplane supervisor stopped:", e)
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def disconnect(self, error):
+        # 切断中のコマンドはすぐに失敗させ、返事を待っていたものにも error を渡す
+        self.connected = False
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        while self.pending:
+            future = self.pending.popleft()
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+        self.disconnect(ConnectionError("Backplane closed"))
+
+    def execute(self, *args, reply=True):
+        if not self.connected:
+            raise ConnectionError("Backplane disconnected")
+        self.writer.write(encode_command(args))
+        future = asyncio.get_running_loop().create_future() if reply else None
+        self.pending.append(future)
+        return future
+
+    async def call(self, *args):
+        try:
+            return await asyncio.wait_for(self.execute(*args), COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError("Backplane command timed out: %s" % args[0])
+
+    async def read_replies(self, reader):
+        # 接続が切れたら例外で終わり、supervise() に知らせる
+        while True:
+            reply = await read_reply(reader)
+            future = self.pending.popleft()
+            if future is None or future.done():
+                continue
+            if isinstance(reply, BackplaneError):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+    async def read_messages(self, reader, writer, handler):
+        try:
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and reply[0] == "message":
+                    try:
+                        handler(*split_message(reply[2]))
+                    except Exception as e:
+                        # 1つのメッセージの処理に失敗しても購読は続ける
+                        print("Error handling backplane message:", e)
+                        traceback.print_exception(type(e), e, e.__traceback__)
+        finally:
+            writer.close()
+
+    def send(self, worker, op, key, payload=""):
+        if not self.connected:
+            # 再接続までの間のメッセージは届けられないので捨てる
+            self.stats["dropped"] += 1
+            return
+        self.execute("PUBLISH", self.channel(worker), "%s %s %s" % (op, key, payload), reply=False)
+
+    def broadcast(self, op, key, payload=""):
+        self.send("*", op, key, payload)
+
+    async def claim(self, name, key, entry, candidates=None):
+        return await self.call("EVALSHA", self.scripts["claim"], 1, self.key(name), key, entry, *(candidates or (key,)))
+
+    async def reserve(self, name, key, entry):
+        return await self.call("HSETNX", self.key(name), key, entry) == 1
+
+    async def take(self, name, key):
+        return await self.call("EVALSHA", self.scripts["take"], 1, self.key(name), key)
+
+    async def release(self, name, key, entry):
+        await self.call("EVALSHA", self.scripts["release"], 1, self.key(name), key, entry)
+
+    async def entries(self, name):
+        flat = await self.call("HGETALL", self.key(name))
+        return dict(zip(flat[::2], flat[1::2]))
+
+def create_backplane(url=None):
+    # redis://[:password@]host[:port][/db] または unix:///path/to/redis.sock
+    if not url or url.startswith("memory:"):
+        return MemoryBackplane()
+    if url.startswith(("redis://", "unix://")):
+        return RedisBackplane(url)
+    raise ValueError("Unsupported backplane URL: %s" % url)
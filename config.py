@@ -28,6 +28,10 @@ PLUGINS = [{
 # Filetype to use for song previews. (mp3/ogg)
 PREVIEW_TYPE = 'mp3'
 
+# ffmpeg processes per app worker that make missing previews in the background.
+# Run `flask warm-previews` to make them for the whole catalog ahead of time.
+PREVIEW_WORKERS = 2
+
 # ----------------------------------------
 # MongoDB (MongoDB Atlas 使用版)
 # 旧式の host/database 設定は使えないため削除。
@@ -40,6 +44,9 @@ MONGO = {
 }
 
 
+# Redis server settings, used for sessions and for the cache.
+# With 'CACHE_TYPE': 'null' the app falls back to a per-process memory cache;
+# set 'redis' to share the catalog, session and chart hash caches between workers.
 REDIS = {
     'CACHE_TYPE': 'null',
     'CACHE_REDIS_HOST': None,
@@ -49,6 +56,33 @@ REDIS = {
 }
 
 
+# How scores are stored in MongoDB. (documents/compact)
+# 'documents' keeps one document per user and song, 'compact' one document per user.
+# Convert existing scores with tools/migrate_scores.py before switching.
+SCORE_STORAGE = 'documents'
+
+# Password hashing. bcrypt runs in a pool of 'workers' processes per app worker (default: 2);
+# when 'queue' more requests are already waiting, logins fail fast with server_busy.
+# 'threads' is the gunicorn --threads value (tools/supervisor.conf): workers + queue is kept
+# below it, so requests are turned away before every thread is stuck waiting on bcrypt.
+# Leave 'queue' as None to use every slot that allows.
+# Changing 'rounds' rehashes each password on its next successful login.
+PASSWORD_HASHING = {
+    'workers': None,
+    'queue': None,
+    'rounds': 12,
+    'threads': 8
+}
+
+# Size limits for /api/upload in bytes. Uploads are streamed to disk and hashed as they
+# arrive; larger requests are refused from their Content-Length before anything is read.
+# Partial uploads are kept outside the served songs directory, in TAIKO_WEB_UPLOAD_TMP_DIR
+# (default: .uploads next to it), which must be on the same filesystem as the songs.
+UPLOAD_LIMITS = {
+    'tja': 2 * 1024 * 1024,
+    'music': 50 * 1024 * 1024
+}
+
 # Secret key used for sessions.
 SECRET_KEY = os.getenv('SECRET_KEY', 'change-me')
 
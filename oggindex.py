@@ -0,0 +1,146 @@
+import os
+import mmap
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Ogg のページ索引（app.py と tools/ から使う）
+# ページの先頭とグラニュール位置（サンプル数）を一度だけ読み、指定した秒に近いページから
+# 先をストリームのヘッダーの後ろにつなげて返せるようにする。変換は一切しない
+
+# "OggS", バージョン, 種類, グラニュール位置, シリアル番号, ページ番号, CRC, セグメント数
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+# 前のページから続くパケットで始まるページ
+CONTINUED = 0x01
+
+# 索引を覚えておく曲の数（プロセスごと）
+CACHE_SIZE = 256
+# 返すときに一度に読むバイト数
+CHUNK_SIZE = 65536
+
+
+class OggIndex:
+    __slots__ = ('path', 'size', 'mtime', 'rate', 'headers', 'starts', 'offsets')
+
+    def __init__(self, path, size, mtime, rate, headers, starts, offsets):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        # グラニュール位置の単位（1秒あたりのサンプル数）
+        self.rate = rate
+        # 識別・コメント・セットアップのヘッダーを含む先頭のページ
+        self.headers = headers
+        # 新しいパケットで始まる音声ページの、最初のサンプルの位置とファイル上の位置
+        self.starts = starts
+        self.offsets = offsets
+
+    def offset(self, seconds):
+        # seconds を含むページ（無ければ最後のページ）の位置
+        if not self.offsets:
+            return len(self.headers)
+        i = bisect_right(self.starts, int(seconds * self.rate)) - 1
+        return self.offsets[max(0, i)]
+
+    def end(self, seconds):
+        # seconds 以降に始まる最初のページの位置（無ければファイルの最後）
+        i = bisect_left(self.starts, int(seconds * self.rate))
+        return self.offsets[i] if i < len(self.offsets) else self.size
+
+    def bounds(self, seconds, length=None):
+        # seconds から length 秒分を含むページの範囲。length が無ければファイルの最後まで
+        start = self.offset(seconds)
+        if not length:
+            return start, self.size
+        return start, max(start, self.end(seconds + length))
+
+    def slice_size(self, seconds, length=None):
+        start, end = self.bounds(seconds, length)
+        return len(self.headers) + end - start
+
+
+def stream_rate(packet):
+    if packet[:7] == b'\x01vorbis':
+        return struct.unpack_from('<I', packet, 12)[0]
+    if packet[:8] == b'OpusHead':
+        # Opus のグラニュール位置は元のサンプリング周波数に関係なく 48kHz
+        return 48000
+    raise ValueError('Unsupported Ogg stream')
+
+
+def build_index(path):
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with buf:
+        size = len(buf)
+        pos = 0
+        serial = None
+        rate = None
+        header_end = None
+        last_granule = 0
+        starts = array('q')
+        offsets = array('q')
+        while pos + PAGE_HEADER.size <= size:
+            capture, version, flags, granule, page_serial, sequence, crc, segments = PAGE_HEADER.unpack_from(buf, pos)
+            if capture != b'OggS':
+                raise ValueError('Not an Ogg page at %s' % pos)
+            body = pos + PAGE_HEADER.size + segments
+            end = body + sum(buf[pos + PAGE_HEADER.size:body])
+            if end > size:
+                # 書きかけ・壊れた末尾は使わない
+                break
+            if serial is None:
+                serial = page_serial
+                rate = stream_rate(buf[body:end])
+            if page_serial == serial:
+                if header_end is None and granule != 0:
+                    header_end = pos
+                if header_end is not None:
+                    if not flags & CONTINUED:
+                        starts.append(last_granule)
+                        offsets.append(pos)
+                    if granule != -1:
+                        last_granule = granule
+            pos = end
+        if header_end is None:
+            raise ValueError('No audio pages')
+        headers = bytes(buf[:header_end])
+    return OggIndex(path, stat.st_size, stat.st_mtime, rate, headers, starts, offsets)
+
+
+cache = OrderedDict()
+cache_lock = threading.Lock()
+
+
+def get_index(path):
+    # ファイルの大きさと更新時刻が変わっていなければ前に作った索引を使う
+    stat = os.stat(path)
+    with cache_lock:
+        index = cache.get(path)
+        if index is not None and index.size == stat.st_size and index.mtime == stat.st_mtime:
+            cache.move_to_end(path)
+            return index
+    index = build_index(path)
+    with cache_lock:
+        cache[path] = index
+        cache.move_to_end(path)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    return index
+
+
+def iter_slice(index, seconds, length=None, chunk_size=CHUNK_SIZE):
+    # ヘッダーのページに続けて、seconds を含むページから length 秒分（無ければファイルの最後）までを返す
+    start, end = index.bounds(seconds, length)
+    yield index.headers
+    with open(index.path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,93 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# bcrypt の計算をプロセスプールで行う（app.py から使う）
+# 計算中と待ち行列の合計が上限に達していたら、待たずに PasswordBusy を投げる
+
+# gunicorn のワーカーごとのプロセス数の既定値（ワーカーの数だけ掛け算になるので小さくする）
+DEFAULT_WORKERS = 2
+# gunicorn のワーカーごとのリクエストを処理するスレッドの数（tools/supervisor.conf の --threads）。
+# 計算中と待ち行列の合計はこれより少なくし、スレッドが全部待たされる前に server_busy を返す
+DEFAULT_THREADS = 8
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def hash_password(password, rounds):
+    started = time.monotonic()
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)), started
+
+
+def check_password(password, hashed):
+    started = time.monotonic()
+    return bcrypt.checkpw(password, hashed), started
+
+
+def pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class PasswordHasher:
+    def __init__(self, workers=None, queue=None, rounds=12, threads=DEFAULT_THREADS):
+        self.workers = workers or min(DEFAULT_WORKERS, os.cpu_count() or 1)
+        # 少なくとも1つのスレッドはパスワード以外のリクエストのために空けておく
+        limit = max(1, threads - 1)
+        self.queue = max(0, limit - self.workers) if queue is None else min(queue, max(0, limit - self.workers))
+        self.rounds = rounds
+        self.slots = threading.BoundedSemaphore(min(self.workers + self.queue, limit))
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.stats = {'calls': 0, 'busy': 0, 'wait': 0.0, 'max_wait': 0.0}
+        # スレッドごとの直前の待ち時間（秒）
+        self.local = threading.local()
+
+    def get_executor(self):
+        # gunicorn が fork した後の各ワーカーで作る
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # リクエストのスレッドから作るので fork は使わない（スレッドのあるプロセスを fork すると
+                # 子プロセスがロックを持ったまま止まることがある）
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['busy'] += 1
+            raise PasswordBusy()
+        try:
+            queued = time.monotonic()
+            result, started = self.get_executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+        # time.monotonic() はプロセス間で共通なので、子プロセスが計算を始めるまでの待ち時間になる
+        wait = max(0.0, started - queued)
+        self.local.wait = wait
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['wait'] += wait
+            self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        return result
+
+    def hash(self, password):
+        return self.run(hash_password, password, self.rounds)
+
+    def check(self, password, hashed):
+        return self.run(check_password, password, hashed)
+
+    def needs_rehash(self, hashed):
+        # "$2b$12$..." のコストが設定と違えば作り直す
+        try:
+            return int(hashed[4:6]) != self.rounds
+        except ValueError:
+            return False
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from ffmpy import FFmpeg
+
+# 曲のプレビュー（preview.<形式>）を作る（app.py と tools/ から使う）
+
+# プレビューの形式ごとの ffmpeg の出力設定
+CODECS = {
+    'mp3': '-codec:a libmp3lame -ar 32000 -b:a 92k',
+    'ogg': '-codec:a libvorbis -ar 32000 -b:a 64k'
+}
+
+# ogg の曲から直接切り出すプレビューの長さ（秒）。ffmpeg で作るプレビューは今までどおり曲の最後まで
+PREVIEW_LENGTH = 30
+
+# 作りかけのファイルがこれより古ければ、作っていたプロセスは落ちたものとみなす（秒）
+STALE_AFTER = 300
+
+
+def part_path(prev_path):
+    # preview.mp3 -> preview.part.mp3（ffmpeg は拡張子で形式を決める）
+    base, ext = os.path.splitext(prev_path)
+    return base + '.part' + ext
+
+
+def make_preview(song_path, prev_path, offset, ext):
+    # 一時ファイルに書き出してから置き換えるので、読む側が書きかけのファイルを見ることはない。
+    # 一時ファイルは O_EXCL で作り、他のプロセスが同じ曲を作っている間は何もしない
+    tmp_path = part_path(prev_path)
+    try:
+        fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(tmp_path) < STALE_AFTER:
+                return False
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        return make_preview(song_path, prev_path, offset, ext)
+    os.close(fd)
+
+    try:
+        ff = FFmpeg(inputs={song_path: '-ss %s' % offset},
+                    outputs={tmp_path: CODECS[ext] + ' -y -loglevel panic'})
+        ff.run()
+        os.replace(tmp_path, prev_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return True
+
+
+class PreviewQueue:
+    # 曲ごとに一つだけ、最大 workers 個の ffmpeg を裏で動かしてプレビューを作る
+    def __init__(self, song_dir, ext='mp3', workers=2):
+        self.song_dir = song_dir
+        self.ext = ext
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stats = {'queued': 0, 'made': 0, 'skipped': 0, 'failed': 0}
+
+    def path(self, song_id):
+        return os.path.join(self.song_dir, str(song_id), 'preview.%s' % self.ext)
+
+    def ready(self, song_id):
+        return os.path.isfile(self.path(song_id))
+
+    def request(self, song_id, song_ext, offset):
+        with self.lock:
+            future = self.pending.get(song_id)
+            if future is not None:
+                return future
+            future = self.executor.submit(self.run, song_id, song_ext, offset)
+            self.pending[song_id] = future
+            self.stats['queued'] += 1
+        # 終わっていればこの場で呼ばれるので、ロックの外で登録する
+        future.add_done_callback(lambda future: self.done(song_id, future))
+        return future
+
+    def run(self, song_id, song_ext, offset):
+        song_path = os.path.join(self.song_dir, str(song_id), 'main.%s' % song_ext)
+        if self.ready(song_id) or not os.path.isfile(song_path):
+            return False
+        return make_preview(song_path, self.path(song_id), offset, self.ext)
+
+    def done(self, song_id, future):
+        with self.lock:
+            self.pending.pop(song_id, None)
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self.stats['failed'] += 1
+            print('Error making preview for song #%s:' % song_id, e)
+            traceback.print_exception(type(e), e, e.__traceback__)
+        elif future.result():
+            self.stats['made'] += 1
+        else:
+            self.stats['skipped'] += 1
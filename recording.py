@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# ================================
+# 対戦の記録（追記型のバイナリログ）
+# ファイル:   "TKR1" + ヘッダーの長さ(varint) + ヘッダー(JSON)
+# レコード:   前のレコードからの経過ミリ秒(varint) + プレイヤー(1バイト, 0 はルームの出来事)
+#             + 種類(1バイト) + 中身の長さ(varint) + 中身
+# 種類 0 は JSON のフレーム、それ以外は server.py のバイナリフレームの種類番号で、中身はその続き
+# ================================
+MAGIC = b"TKR1"
+EXTENSION = ".tkr"
+
+# 記録をディスクに書き出す間隔（秒）
+FLUSH_INTERVAL = 1.0
+
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+class Recording:
+    # 書き込み用スレッドだけが file / start / last に触る
+    __slots__ = ("name", "path", "header", "frames", "start", "last", "file", "finished")
+
+    def __init__(self, name, path, header):
+        self.name = name
+        self.path = path
+        self.header = header
+        # (time.monotonic(), プレイヤー, フレーム) のリスト。中継の処理では足すだけ
+        self.frames = []
+        # 最初のフレームの時刻と、最後に書いたレコードの開始からのミリ秒
+        self.start = None
+        self.last = 0
+        self.file = None
+        self.finished = False
+
+class Recorder:
+    # 中継中のルームのフレームを溜め、定期的に別スレッドでまとめて追記する
+    def __init__(self, directory, convert):
+        self.directory = directory
+        # フレーム（str / bytes）を (種類, 中身のバイト列) にする関数。書き込み用スレッドで呼ばれる
+        self.convert = convert
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+        self.active = set()
+        self.task = None
+        self.frames = 0
+        self.bytes = 0
+        self.recordings = 0
+
+    def start(self, name, header):
+        os.makedirs(self.directory, exist_ok=True)
+        recording = Recording(name, os.path.join(self.directory, name + EXTENSION), header)
+        self.active.add(recording)
+        self.recordings += 1
+        return recording
+
+    def finish(self, recording):
+        recording.finished = True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush(loop)
+
+    def flush(self, loop):
+        for recording in list(self.active):
+            frames = recording.frames
+            if frames:
+                recording.frames = []
+                self.frames += len(frames)
+            if recording.finished:
+                self.active.discard(recording)
+            elif not frames:
+                continue
+            future = loop.run_in_executor(self.executor, self.write, recording, frames, recording.finished)
+            future.add_done_callback(write_done)
+
+    def close(self):
+        for recording in self.active:
+            recording.finished = True
+        self.flush(asyncio.get_running_loop())
+        self.executor.shutdown(wait=True)
+
+    def write(self, recording, frames, finished):
+        out = bytearray()
+        if recording.file is None:
+            header = json.dumps(recording.header, separators=(",", ":")).encode("utf-8")
+            out += MAGIC
+            write_varint(out, len(header))
+            out += header
+            recording.file = open(recording.path, "ab")
+            recording.start = frames[0][0] if frames else time.monotonic()
+        start = recording.start
+        last = recording.last
+        for stamp, player, data in frames:
+            kind, payload = self.convert(data)
+            ms = max(last, int((stamp - start) * 1000))
+            write_varint(out, ms - last)
+            last = ms
+            out.append(player)
+            out.append(kind)
+            write_varint(out, len(payload))
+            out += payload
+        recording.last = last
+        recording.file.write(out)
+        self.bytes += len(out)
+        if finished:
+            recording.file.close()
+        else:
+            recording.file.flush()
+
+def write_done(future):
+    if not future.cancelled() and future.exception() is not None:
+        e = future.exception()
+        print("Error writing recording:", e)
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+def read_header(buf):
+    # buf は bytes でも mmap でもよい。(ヘッダー, 最初のレコードの位置) を返す
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a recording")
+    length, pos = read_varint(buf, len(MAGIC))
+    return json.loads(bytes(buf[pos:pos + length])), pos + length
+
+def iter_records(buf, pos):
+    # (開始からのミリ秒, プレイヤー, 種類, 中身) を順に返す。書きかけの末尾は読まない
+    ms = 0
+    size = len(buf)
+    while pos < size:
+        try:
+            delta, next_pos = read_varint(buf, pos)
+            player = buf[next_pos]
+            kind = buf[next_pos + 1]
+            length, next_pos = read_varint(buf, next_pos + 2)
+        except IndexError:
+            return
+        if next_pos + length > size:
+            return
+        ms += delta
+        yield ms, player, kind, bytes(buf[next_pos:next_pos + length])
+        pos = next_pos + length
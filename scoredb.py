@@ -0,0 +1,171 @@
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+# スコアの保存・読み込み（app.py と tools/ から使う）
+# documents: scores コレクションに (username, hash) ごとに1件
+# compact:   user_scores コレクションにユーザーごとに1件 {_id: username, scores: {hash: スコア文字列}}
+# どちらも保存のたびに各スコアに次のバージョンを記録してから、users の score_version を上げる。
+# インポートで全体を置き換えたときは score_reset にもそのバージョンを残す
+
+# 一度に書き込むスコアの数。インポートはこの単位で順に書き込む
+CHUNK_SIZE = 1000
+
+
+def chunks(scores, size=CHUNK_SIZE):
+    # hash -> スコア文字列 の辞書を size 件ずつ返す。同じ hash は後のものが勝つ
+    chunk = {}
+    for score in scores:
+        chunk[score['hash']] = score['score']
+        if len(chunk) >= size:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+def current_version(db, username):
+    # ユーザーがいなければ None
+    user = db.users.find_one({'username': username}, {'_id': False, 'score_version': True})
+    if not user:
+        return None
+    return user.get('score_version') or 0
+
+
+def publish_version(db, username, previous, version, replace=False):
+    # ユーザーのバージョンが読んだときのままなら上げる
+    update = {'score_version': version}
+    if replace:
+        update['score_reset'] = version
+    query = {'username': username, 'score_version': previous or {'$in': [0, None]}}
+    return db.users.update_one(query, {'$set': update}).modified_count == 1
+
+
+def save_versioned(db, username, replace, write):
+    # 先にスコアを次のバージョンで書いてから、ユーザーのバージョンを上げる（bump_catalog と同じ）。
+    # 途中で他の保存にバージョンを上げられたら、新しい番号で書き直す。
+    # こうすると、同期トークンとして渡したバージョン以下の番号でスコアが後から書かれることはない
+    while True:
+        previous = current_version(db, username)
+        if previous is None:
+            return write(0)
+        saved = write(previous + 1)
+        if publish_version(db, username, previous, previous + 1, replace):
+            return saved
+
+
+class DocumentScores:
+    def __init__(self, db):
+        self.db = db
+
+    def create_indexes(self):
+        # (username, hash) の組は一つだけ。username だけでの検索にも使える。
+        # 以前の保存処理（同時に保存した場合など）で重複が残っていると一意の索引は作れないので、
+        # その間は普通の索引で動かす。tools/migrate_scores.py --dedupe で重複を消せば次の起動で作られる
+        try:
+            self.db.scores.create_index([('username', 1), ('hash', 1)], unique=True)
+        except OperationFailure as e:
+            if e.code != 11000:
+                raise
+            print('Duplicate scores found, the unique (username, hash) index was not created.'
+                  ' Run tools/migrate_scores.py --dedupe to remove them.')
+            self.db.scores.create_index([('username', 1), ('hash', 1)])
+
+    def dedupe(self):
+        # 同じ (username, hash) のスコアが複数あれば、最後に書かれたもの（_id が最大のもの）だけを残す
+        removed = 0
+        duplicates = self.db.scores.aggregate([
+            {'$group': {'_id': {'username': '$username', 'hash': '$hash'}, 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ], allowDiskUse=True)
+        for group in duplicates:
+            ids = sorted(group['ids'])[:-1]
+            removed += self.db.scores.delete_many({'_id': {'$in': ids}}).deleted_count
+        return removed
+
+    def save(self, username, scores, replace=False):
+        scores = list(scores)
+        return save_versioned(self.db, username, replace, lambda version: self.write(username, scores, version, replace))
+
+    def write(self, username, scores, version, replace):
+        if replace:
+            self.db.scores.delete_many({'username': username})
+
+        saved = 0
+        for chunk in chunks(scores):
+            self.db.scores.bulk_write([
+                UpdateOne({'username': username, 'hash': hash}, {'$set': {'score': score, 'version': version}}, upsert=True)
+                for hash, score in chunk.items()
+            ], ordered=False)
+            saved += len(chunk)
+        return saved
+
+    def load(self, username, since=0):
+        # since より後のバージョンで保存されたスコアだけを返す
+        query = {'username': username}
+        if since:
+            query['version'] = {'$gt': since}
+        return [{'hash': score['hash'], 'score': score['score']}
+                for score in self.db.scores.find(query, {'_id': False, 'hash': True, 'score': True})]
+
+    def remove(self, username):
+        self.db.scores.delete_many({'username': username})
+
+
+def encode_field(hash):
+    # フィールド名に使えない "." と先頭の "$" を避ける
+    return hash.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def decode_field(field):
+    return field.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+class CompactScores:
+    # 読み込みも書き込みも1回の往復で済む。1件の上限 (16MB) はスコア数万件分
+    def __init__(self, db):
+        self.db = db
+
+    def create_indexes(self):
+        # _id がユーザー名なので追加の索引は要らない
+        pass
+
+    def save(self, username, scores, replace=False):
+        scores = list(scores)
+        return save_versioned(self.db, username, replace, lambda version: self.write(username, scores, version, replace))
+
+    def write(self, username, scores, version, replace):
+        saved = 0
+        for chunk in chunks(scores):
+            fields = {encode_field(hash): score for hash, score in chunk.items()}
+            if replace and not saved:
+                # インポートの最初の塊で全体を置き換え、残りは部分更新で足す
+                update = {'$set': {'scores': fields, 'versions': {field: version for field in fields}}}
+            else:
+                update = {'$set': {}}
+                for field, score in fields.items():
+                    update['$set']['scores.' + field] = score
+                    update['$set']['versions.' + field] = version
+            self.db.user_scores.update_one({'_id': username}, update, upsert=True)
+            saved += len(chunk)
+        if replace and not saved:
+            self.db.user_scores.delete_one({'_id': username})
+        return saved
+
+    def load(self, username, since=0):
+        doc = self.db.user_scores.find_one({'_id': username})
+        if not doc:
+            return []
+        versions = doc.get('versions', {})
+        return [{'hash': decode_field(field), 'score': score} for field, score in doc['scores'].items()
+                if not since or versions.get(field, 0) > since]
+
+    def remove(self, username):
+        self.db.user_scores.delete_one({'_id': username})
+
+
+def create_store(db, kind=None):
+    if not kind or kind == 'documents':
+        return DocumentScores(db)
+    if kind == 'compact':
+        return CompactScores(db)
+    raise ValueError('Unsupported score storage: %s' % kind)
@@ -1,137 +1,1753 @@
 import os
+import sys
+import re
+import gzip
 import json
+import mmap
+import random
+import struct
+import time
 import asyncio
+import hashlib
+import ipaddress
+import itertools
+import threading
 import traceback
 from aiohttp import web
 import aiohttp
 import aiohttp_jinja2
 import jinja2
 
+from backplane import create_backplane
+from recording import Recorder, read_header, iter_records, EXTENSION
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # ================================
 # グローバル状態
 # ================================
 server_status = {
-    "users": [],
+    # このワーカーの接続（ID -> Connection）
+    "users": {},
+    # このワーカーで待機・招待中の接続。全ワーカー分はバックプレーンの登録簿にある
+    # waiting は (曲, コース) のキー -> WaitingEntry
     "waiting": {},
-    "invites": {}
+    "invites": {},
+    # ルームID -> Room
+    "rooms": {},
+    # 別ワーカーにいる対戦相手（"ワーカーID/接続ID" -> RemoteConnection）
+    "remote": {}
+}
+
+consonants = "bcdfghjklmnpqrstvwxyz"
+
+# 対戦中は中身を見ずに相手へそのまま転送するフレーム
+RELAY_TYPES = frozenset(["note", "drumroll", "branch", "gameresults"])
+# セッションの曲選択中に相手へそのまま転送するフレーム
+SONGSEL_RELAY_TYPES = frozenset(["getcrowns", "crowns"])
+
+# このサブプロトコルで接続したクライアントは note / drumroll / branch をバイナリで送受信する
+#   note:     >BhfB  種類(1), score, ms, フラグ(bit0-1: dai, bit2: reverse, bit3: ms あり)
+#   drumroll: >Bff   種類(2), pace, kaAmount（無いときは NaN）
+#   branch:   >BB    種類(3), normal / advanced / master の番号
+BINARY_PROTOCOL = "taiko-bin"
+BINARY_TYPES = {1: "note", 2: "drumroll", 3: "branch"}
+NOTE_FRAME = struct.Struct(">BhfB")
+DRUMROLL_FRAME = struct.Struct(">Bff")
+BRANCH_FRAME = struct.Struct(">BB")
+BRANCH_NAMES = ("normal", "advanced", "master")
+BINARY_NAMES = frozenset(BINARY_TYPES.values())
+
+# permessage-deflate を有効にするか。aiohttp は接続単位でしか切り替えられず、
+# 有効にすると全フレームが圧縮されるため、既定では無効にしている
+WS_DEFLATE = os.environ.get("TAIKO_WEB_WS_DEFLATE", "") not in ("", "0", "false")
+
+# 送信キューの上限。これを超えたクライアントは遅すぎるとみなして切断する
+SEND_QUEUE_LIMIT = 256
+# これ以上溜まっている接続にはステータスを送らずに捨てる
+STATUS_DROP_DEPTH = 16
+# ステータス送信をまとめる間隔（秒）
+STATUS_INTERVAL = 0.05
+
+send_stats = {
+    "dropped": 0,
+    "kicked": 0
+}
+
+# 何も受信しないまま HEARTBEAT_INTERVAL 秒経つと ping を送り、
+# さらに HEARTBEAT_MISSES 回分応答が無ければ切断済みとみなして片付ける
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_MISSES = 2
+# タイミングホイールの1目盛り（秒）と目盛りの数
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 64
+
+heartbeat_stats = {
+    "pings": 0,
+    # 応答が無く片付けた接続（ゾンビ）の数
+    "reaped": 0
+}
+
+# 観戦者の上限（ルームごと）と、観戦者ごとに溜めておく送信のまとまりの数。
+# 追いつけない観戦者は古いまとまりを捨てて先へ進む（対戦中のプレイヤーは待たせない）
+SPECTATOR_LIMIT = 1000
+SPECTATOR_QUEUE_LIMIT = 8
+# 観戦者への送信をまとめる間隔（秒）
+SPECTATE_INTERVAL = 0.05
+# 1回のコールバックで送る観戦者の数。残りは次に回して、その間にプレイヤーのフレームを処理する
+FANOUT_CHUNK = 64
+
+spectate_stats = {
+    "batches": 0,
+    "skipped": 0
+}
+
+# コース。待機中の相手は同じコースを優先し、いなければ近いコースの相手と組む
+COURSES = ("easy", "normal", "hard", "oni", "ura")
+COURSE_ORDER = {
+    course: tuple(sorted(COURSES, key=lambda other: abs(COURSES.index(other) - COURSES.index(course))))
+    for course in COURSES
+}
+# 待機の期限（秒）。過ぎたら登録を消して曲選択に戻す。
+# 落ちたワーカーが残した登録は、さらに WAITING_GRACE 秒過ぎたらステータス送信のついでに消す
+WAITING_TIMEOUT = 300
+WAITING_GRACE = 60
+
+match_stats = {
+    "same": 0,
+    "other": 0,
+    "expired": 0,
+    "swept": 0
+}
+
+# 受信フレームの上限（1秒あたりの量, まとめて送れる量）。note / drumroll / branch / gameresults と
+# バイナリフレームは note の枠、それ以外（join / invite / leave / songsel など）は control の枠を使う。
+# 接続ごとの枠とは別に、同じ IP アドレスからの接続全体にも枠を設ける
+# （ループバックは負荷試験や同じホストのプロキシなので除く）
+CONTROL_BUDGET = (10, 30)
+NOTE_BUDGET = (60, 120)
+ADDRESS_CONTROL_BUDGET = (50, 200)
+ADDRESS_NOTE_BUDGET = (600, 1200)
+# リバースプロキシの後ろで動かすときは X-Forwarded-For の最後のアドレスを使う
+TRUST_FORWARDED = os.environ.get("TAIKO_WEB_TRUST_FORWARDED", "") not in ("", "0", "false")
+
+throttle_stats = {
+    "control": 0,
+    "note": 0,
+    "address_control": 0,
+    "address_note": 0
+}
+
+# 送信キューに積むと ping フレームを送る
+PING_FRAME = object()
+
+# /metrics で種類ごとに数えるフレーム。それ以外は "other" にまとめる（ラベルが無限に増えないように）
+FRAME_TYPES = frozenset([
+    "join", "invite", "leave", "gamestart", "gameend", "gameload", "waiting", "left", "users", "name", "session",
+    "note", "drumroll", "branch", "gameresults", "songsel", "catjump", "getcrowns", "crowns", "spectate", "spectating"
+])
+
+frame_stats = {
+    "in": {},
+    "out": {},
+    # 相手へそのまま転送したフレームのバイト数
+    "relayed_bytes": 0,
+    "sent_bytes": 0
 }
 
+# イベントループの遅延を測る間隔（秒）と、ブロックとみなしてスタックを出す閾値（秒）
+LAG_SAMPLE_INTERVAL = 0.1
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BLOCK_THRESHOLD = float(os.environ.get("TAIKO_WEB_BLOCK_THRESHOLD", 0.25))
+
+# API のファイルが更新されていないか確認する間隔（秒）
+FILE_POLL_INTERVAL = 1.0
+
+# 複数ワーカー（gunicorn -w 4 など）で動かすときは TAIKO_WEB_BACKPLANE に
+# redis://host:6379/0 や unix:///path/to/redis.sock を指定する
+backplane = create_backplane(os.environ.get("TAIKO_WEB_BACKPLANE"))
+connection_ids = itertools.count(1)
+room_ids = itertools.count(1)
+recording_ids = itertools.count(1)
+
+# 対戦を記録するディレクトリ。指定したときだけ記録し、/api/replays で読めるようにする
+RECORD_DIR = os.environ.get("TAIKO_WEB_RECORD_DIR")
+REPLAY_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+def msgobj(msg_type, value=None):
+    if value is None:
+        return json.dumps({"type": msg_type}, separators=(",", ":"))
+    return json.dumps({"type": msg_type, "value": value}, separators=(",", ":"))
+
+def frame_prefix(data):
+    # p2.js は JSON.stringify({type: ..., value: ...}) で送ってくるので
+    # 先頭を見るだけで種類が分かる
+    if data.startswith('{"type":"'):
+        end = data.find('"', 9)
+        if end != -1:
+            return data[9:end]
+    elif data.startswith('{"type": "'):
+        end = data.find('"', 10)
+        if end != -1:
+            return data[10:end]
+    return None
+
+def frame_type(data):
+    # 先頭で分からない形のときだけデコードする
+    msg_type = frame_prefix(data)
+    if msg_type is not None:
+        return msg_type
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(obj, dict):
+        return obj.get("type")
+    return None
+
+def decode_binary(data):
+    # バイナリフレームを古いクライアント向けの JSON に戻す
+    try:
+        msg_type = BINARY_TYPES[data[0]]
+        if msg_type == "note":
+            code, score, ms, flags = NOTE_FRAME.unpack(data)
+            value = {"score": score}
+            if flags & 8:
+                value["ms"] = round(ms, 3)
+                value["dai"] = flags & 3
+            if flags & 4:
+                value["reverse"] = True
+        elif msg_type == "drumroll":
+            code, pace, ka_amount = DRUMROLL_FRAME.unpack(data)
+            value = {"pace": round(pace, 3)}
+            if ka_amount == ka_amount:
+                value["kaAmount"] = round(ka_amount, 3)
+        else:
+            code, branch = BRANCH_FRAME.unpack(data)
+            value = BRANCH_NAMES[branch]
+    except (IndexError, KeyError, struct.error):
+        return None
+    return msgobj(msg_type, value)
+
+def encode_binary(msg_type, value):
+    # JSON のフレームをバイナリにする。表せない値のときは None
+    try:
+        if msg_type == "note":
+            flags = 0
+            ms = 0.0
+            if "ms" in value:
+                ms = value["ms"]
+                flags = 8 | value.get("dai", 0) & 3
+            if value.get("reverse"):
+                flags |= 4
+            return NOTE_FRAME.pack(1, value["score"], ms, flags)
+        elif msg_type == "drumroll":
+            return DRUMROLL_FRAME.pack(2, value["pace"], value.get("kaAmount", float("nan")))
+        elif msg_type == "branch":
+            return BRANCH_FRAME.pack(3, BRANCH_NAMES.index(value))
+    except (KeyError, TypeError, ValueError, struct.error):
+        pass
+    return None
+
+def valid_frame(data):
+    # 観戦者へのまとめには文字列のまま埋め込むので、1つの JSON オブジェクトになっているか確かめる
+    # （"...}],[0,{...}" のようなフレームで別のイベントを紛れ込ませたり、まとめ全体を壊したりできないように）
+    try:
+        return isinstance(json.loads(data), dict)
+    except ValueError:
+        return False
+
+def valid_key(value):
+    return isinstance(value, (str, int)) and not isinstance(value, bool) and value != ""
+
+def registry_entry(user, **value):
+    value["worker"] = backplane.worker_id
+    value["conn"] = user.id
+    return json.dumps(value, separators=(",", ":"))
+
+def record_frame(data):
+    # 記録用に (種類, 中身) にする。note / drumroll / branch は JSON で届いてもバイナリにして小さくする。
+    # 記録の書き込み用スレッドで呼ばれる
+    if data.__class__ is not str:
+        return data[0], data[1:]
+    if frame_prefix(data) in BINARY_NAMES:
+        try:
+            obj = json.loads(data)
+        except ValueError:
+            obj = None
+        if isinstance(obj, dict):
+            binary = encode_binary(obj.get("type"), obj.get("value"))
+            if binary is not None:
+                return binary[0], binary[1:]
+    return 0, data.encode("utf-8")
+
+def replay_frame(kind, payload):
+    # 記録のレコードを JSON のフレームに戻す。/api/replays の行にそのまま埋め込むので、
+    # 検証を入れる前に記録されたものも含めて、1つの JSON オブジェクトでなければ捨てる
+    if kind == 0:
+        frame = payload.decode("utf-8", "replace")
+        return frame if valid_frame(frame) else None
+    return decode_binary(bytes([kind]) + payload)
+
+recorder = Recorder(RECORD_DIR, record_frame) if RECORD_DIR else None
+
+def count_frame(counter, msg_type):
+    if msg_type not in FRAME_TYPES:
+        msg_type = "other"
+    counter[msg_type] = counter.get(msg_type, 0) + 1
+
+def background(coro):
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(task_done)
+    return task
+
+def matchmaking(user, coro):
+    # バックプレーンに届かないときは待たせ続けず、待機前の状態に戻す
+    async def run():
+        try:
+            await coro
+        except ConnectionError as e:
+            print("Matchmaking failed:", e)
+            if user.ws is not None and user.action == "joining":
+                user.action = "ready"
+                user.send(msgobj("gameend"))
+    return background(run())
+
+def task_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        print("Error in background task:", e)
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+# ================================
+# 受信フレームの流量制限
+# ================================
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, budget):
+        self.rate, self.burst = budget
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def take(self, now):
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.stamp = now
+        if tokens > self.burst:
+            tokens = self.burst
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+class AddressBudget:
+    # 同じ IP アドレスからの接続で共有する枠。最後の接続が切れたら消す
+    __slots__ = ("address", "control", "note", "users")
+
+    def __init__(self, address):
+        self.address = address
+        self.control = TokenBucket(ADDRESS_CONTROL_BUDGET)
+        self.note = TokenBucket(ADDRESS_NOTE_BUDGET)
+        self.users = 0
+
+address_budgets = {}
+
+def client_address(request):
+    if TRUST_FORWARDED:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return request.remote
+
+def address_budget(address):
+    try:
+        if address is None or ipaddress.ip_address(address).is_loopback:
+            return None
+    except ValueError:
+        pass
+    budget = address_budgets.get(address)
+    if budget is None:
+        budget = address_budgets[address] = AddressBudget(address)
+    budget.users += 1
+    return budget
+
+def release_budget(budget):
+    budget.users -= 1
+    if budget.users <= 0 and address_budgets.get(budget.address) is budget:
+        del address_budgets[budget.address]
+
+def allow_frame(user, note):
+    # JSON をデコードする前に呼び、枠を超えたフレームは捨てる
+    now = time.monotonic()
+    budget = user.budget
+    if note:
+        if not user.note_bucket.take(now):
+            throttle_stats["note"] += 1
+            return False
+        if budget is not None and not budget.note.take(now):
+            throttle_stats["address_note"] += 1
+            return False
+    else:
+        if not user.control_bucket.take(now):
+            throttle_stats["control"] += 1
+            return False
+        if budget is not None and not budget.control.take(now):
+            throttle_stats["address_control"] += 1
+            return False
+    return True
+
+# ================================
+# タイマー
+# ================================
+class TimingWheel:
+    # 期限ごとのスロットに接続を入れておき、1目盛りごとに1スロットだけ処理する。
+    # 登録・取り消しは O(1) で、接続ごとにタスクやタイマーを作らない
+    def __init__(self, on_expire, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots = [set() for i in range(slots)]
+        self.position = 0
+        self.handle = None
+
+    def schedule(self, item, delay):
+        ticks = min(max(1, int(-(-delay // self.tick))), len(self.slots) - 1)
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot].add(item)
+        item.slot = slot
+
+    def cancel(self, item):
+        if item.slot is not None:
+            self.slots[item.slot].discard(item)
+            item.slot = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.handle = loop.call_later(self.tick, self.advance, loop)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def advance(self, loop):
+        self.handle = loop.call_later(self.tick, self.advance, loop)
+        self.position = (self.position + 1) % len(self.slots)
+        expired = self.slots[self.position]
+        if expired:
+            self.slots[self.position] = set()
+            for item in expired:
+                item.slot = None
+                self.on_expire(item)
+
+# ================================
+# 接続とルーム
+# ================================
+class Connection:
+    __slots__ = ("id", "ws", "transport", "binary", "queue", "writer", "action", "session", "name", "don", "gameid", "diff", "player", "room", "proxy", "entry", "missed", "slot", "control_bucket", "note_bucket", "budget", "watching")
+
+    def __init__(self, ws, transport=None):
+        self.id = next(connection_ids)
+        self.ws = ws
+        self.transport = transport
+        # バイナリフレームを受け取れるか
+        self.binary = False
+        self.queue = []
+        self.writer = None
+        self.action = "ready"
+        self.session = False
+        self.name = None
+        self.don = None
+        self.gameid = None
+        self.diff = None
+        self.player = 1
+        self.room = None
+        # 別ワーカーのルームに入っているときは、そのワーカーID
+        self.proxy = None
+        # バックプレーンの登録簿に書いた内容
+        self.entry = None
+        # 最後に受信してから経ったハートビート間隔の数と、タイミングホイール上の位置
+        self.missed = 0
+        self.slot = None
+        # 受信フレームの上限。ソケットを持つ接続だけに設定する
+        self.control_bucket = None
+        self.note_bucket = None
+        # 同じ IP アドレスの接続と共有する枠（AddressBudget）
+        self.budget = None
+        # 観戦中のルーム
+        self.watching = None
+
+    @property
+    def peer(self):
+        room = self.room
+        if room is None:
+            return None
+        return room.p2 if room.p1 is self else room.p1
+
+    def send(self, data, droppable=False):
+        # 送信キューに積むだけで待たない。実際の書き込みは flush() が行う
+        ws = self.ws
+        if ws is None or ws.closed:
+            return
+        queue = self.queue
+        if droppable and len(queue) >= STATUS_DROP_DEPTH:
+            send_stats["dropped"] += 1
+            return
+        if len(queue) >= SEND_QUEUE_LIMIT:
+            self.kick()
+            return
+        queue.append(data)
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        ws = self.ws
+        try:
+            while self.queue and not ws.closed:
+                batch = self.queue
+                self.queue = []
+                for data in batch:
+                    if data.__class__ is str:
+                        await ws.send_str(data)
+                        msg_type = data[9:data.find('"', 9)] if data.startswith('{"type":"') else None
+                    elif data is PING_FRAME:
+                        await ws.ping()
+                        continue
+                    else:
+                        await ws.send_bytes(data)
+                        msg_type = BINARY_TYPES.get(data[0])
+                    count_frame(frame_stats["out"], msg_type)
+                    frame_stats["sent_bytes"] += len(data)
+        except (ConnectionError, RuntimeError):
+            self.queue = []
+        finally:
+            self.writer = None
+
+    def watch(self, batch):
+        # 観戦者向け。キューが一杯なら切断せず、いちばん古いまとまりを捨てる
+        ws = self.ws
+        if ws is None or ws.closed:
+            return
+        queue = self.queue
+        if len(queue) >= SPECTATOR_QUEUE_LIMIT:
+            del queue[0]
+            spectate_stats["skipped"] += 1
+        queue.append(batch)
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.flush())
+
+    def kick(self):
+        # 送信が追いつかないクライアントは他を待たせないよう切断する
+        send_stats["kicked"] += 1
+        self.queue = []
+        if self.transport is not None:
+            self.transport.abort()
+        elif self.ws is not None:
+            asyncio.ensure_future(self.ws.close())
+
+    def detach(self):
+        pass
+
+class RemoteConnection(Connection):
+    # 別ワーカーにいる相手。送信はバックプレーン経由でそのワーカーへ流す
+    __slots__ = ("worker", "key")
+
+    def __init__(self, worker, conn_id):
+        Connection.__init__(self, None)
+        self.id = conn_id
+        self.worker = worker
+        self.key = "%s/%s" % (worker, conn_id)
+
+    def send(self, data, droppable=False):
+        if data.__class__ is str:
+            backplane.send(self.worker, "S", self.id, data)
+        else:
+            # バイナリは latin-1 で文字列にして運ぶ（1バイト = 1文字なので元に戻せる）
+            backplane.send(self.worker, "SB", self.id, data.decode("latin-1"))
+
+    def kick(self):
+        pass
+
+    def detach(self):
+        # ルームが無くなったら相手側のワーカーに接続を返す
+        server_status["remote"].pop(self.key, None)
+        backplane.send(self.worker, "R", self.id)
+
+class Room:
+    __slots__ = ("id", "p1", "p2", "song", "spectators", "pending", "recording")
+
+    def __init__(self, p1, p2, song=None):
+        self.id = next(room_ids)
+        self.p1 = p1
+        self.p2 = p2
+        p1.room = self
+        p1.player = 1
+        p2.room = self
+        p2.player = 2
+        self.song = song
+        # 観戦者の集合と、次のコールバックでまとめて送るフレーム（どちらも無ければ None）
+        self.spectators = None
+        self.pending = None
+        # 記録中なら recording.Recording
+        self.recording = None
+        server_status["rooms"][self.id] = self
+
+    def close(self):
+        server_status["rooms"].pop(self.id, None)
+        stop_recording(self)
+        for user in (self.p1, self.p2):
+            if user.room is self:
+                user.room = None
+                user.detach()
+        spectators = self.spectators
+        if spectators:
+            # まだ送っていないフレームと一緒に gameend を送り、観戦者を待機状態に戻す
+            self.spectators = None
+            pending = self.pending or []
+            self.pending = None
+            pending.append("[0,%s]" % msgobj("gameend"))
+            batch = '{"type":"spectate","value":[%s]}' % ",".join(pending)
+            fan_out(self, list(spectators), batch, 0, True)
+
+    def info(self):
+        return {
+            "id": self.id,
+            "song": self.song,
+            "players": [{"name": user.name, "don": user.don, "diff": user.diff} for user in (self.p1, self.p2)],
+            "spectators": len(self.spectators or ())
+        }
+
+    def spectate(self, player, data):
+        # 観戦者向けのフレームは SPECTATE_INTERVAL 分まとめ、まとめたものを1回だけエンコードして全員で共有する。
+        # プレイヤーのフレーム処理ではリストに足すだけ
+        pending = self.pending
+        if pending is None:
+            pending = self.pending = []
+            asyncio.get_running_loop().call_later(SPECTATE_INTERVAL, self.fanout)
+        pending.append("[%d,%s]" % (player, data))
+
+    def fanout(self):
+        pending = self.pending
+        self.pending = None
+        if not pending or not self.spectators:
+            return
+        batch = '{"type":"spectate","value":[%s]}' % ",".join(pending)
+        fan_out(self, list(self.spectators), batch, 0)
+
+def start_recording(room, msg):
+    if recorder is None or room.recording is not None:
+        return
+    name = "%s-%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), backplane.worker_id, next(recording_ids))
+    header = room.info()
+    del header["spectators"]
+    header["worker"] = backplane.worker_id
+    header["started"] = int(time.time() * 1000)
+    room.recording = recorder.start(name, header)
+    room.recording.frames.append((time.monotonic(), 0, msg))
+
+def stop_recording(room):
+    recording = room.recording
+    if recording is not None:
+        room.recording = None
+        recording.frames.append((time.monotonic(), 0, msgobj("gameend")))
+        recorder.finish(recording)
+
+def fan_out(room, spectators, batch, start, last=False):
+    # 観戦者が多いときは FANOUT_CHUNK 人ずつ送る。続きは call_soon で後ろに並ぶので、
+    # 前のまとまりを送り終えた観戦者にだけ次のまとまりが届き、順番は入れ替わらない
+    if start == 0:
+        spectate_stats["batches"] += 1
+    end = start + FANOUT_CHUNK
+    for spectator in spectators[start:end]:
+        if spectator.watching is not room:
+            continue
+        spectator.watch(batch)
+        if last:
+            spectator.watching = None
+            spectator.action = "ready"
+            spectator.send(status_event())
+    if end < len(spectators):
+        asyncio.get_running_loop().call_soon(fan_out, room, spectators, batch, end, last)
+
+def unwatch(user):
+    room = user.watching
+    user.watching = None
+    if room is not None and room.spectators:
+        room.spectators.discard(user)
+
+def name_event(user):
+    return msgobj("name", {"name": user.name, "don": user.don})
+
+def status_event():
+    return status_publisher.payload
+
+def get_invite():
+    return "".join([random.choice(consonants) for x in range(5)])
+
 # ================================
 # 全ユーザーにステータス送信
 # ================================
-async def notify_status():
-    msg = json.dumps({
-        "type": "status",
-        "users": len(server_status["users"]),
-        "waiting": list(server_status["waiting"].keys())
-    })
-    for u in server_status["users"]:
-        ws = u.get("ws")
-        if ws is not None and not ws.closed:
-            await ws.send_str(msg)
+class StatusPublisher:
+    # 変更通知を1ティック分まとめ、エンコード1回で全員に送る
+    def __init__(self, interval=STATUS_INTERVAL):
+        self.interval = interval
+        self.handle = None
+        self.local = False
+        self.payload = msgobj("users", [])
+        self.broadcasts = 0
+        self.coalesced = 0
+        # 登録簿の文字列 -> (ステータス用の値, 登録時刻)。変わっていない登録はデコードし直さない
+        self.summaries = {}
+
+    def notify(self, local=True):
+        if local:
+            self.local = True
+        if self.handle is None:
+            loop = asyncio.get_running_loop()
+            self.handle = loop.call_later(self.interval, self.start)
+        else:
+            self.coalesced += 1
+
+    def start(self):
+        self.handle = None
+        background(self.publish())
+
+    async def publish(self):
+        if self.local:
+            # 他のワーカーにも待機リストが変わったことを知らせる
+            self.local = False
+            backplane.broadcast("N", backplane.worker_id)
+        waiting = await backplane.entries("waiting")
+        now = time.time()
+        previous = self.summaries
+        summaries = self.summaries = {}
+        value = []
+        for key, entry in waiting.items():
+            summary = previous.get(entry)
+            if summary is None:
+                info = json.loads(entry)
+                summary = ({"id": info["id"], "diff": info["diff"]}, info.get("time", now))
+            if now - summary[1] > WAITING_TIMEOUT + WAITING_GRACE:
+                match_stats["swept"] += 1
+                background(backplane.release("waiting", key, entry))
+                continue
+            summaries[entry] = summary
+            value.append(summary[0])
+        self.payload = msgobj("users", value)
+        self.broadcasts += 1
+        for user in server_status["users"].values():
+            if user.action == "ready":
+                user.send(self.payload, droppable=True)
+
+status_publisher = StatusPublisher()
+
+def notify_status():
+    status_publisher.notify()
+
+async def release_entry(name, key, entry, notify=True):
+    await backplane.release(name, key, entry)
+    if notify:
+        notify_status()
+
+def end_room(user, user_msg="gameend"):
+    # ルームを解散して両者を待機状態に戻す
+    peer = user.peer
+    if peer is None:
+        return
+    user.room.close()
+    for u in (user, peer):
+        u.action = "ready"
+        u.session = False
+    msg = status_event()
+    peer.send(msgobj("gameend"))
+    peer.send(msg)
+    if user_msg:
+        user.send(msgobj(user_msg))
+        user.send(msg)
+
+# ================================
+# 対戦相手探し
+# ================================
+class WaitingEntry:
+    __slots__ = ("user", "key", "slot")
+
+    def __init__(self, user, key):
+        self.user = user
+        self.key = key
+        self.slot = None
+
+class MatchPool:
+    # 待機中の接続を (曲, コース) のバケットで持つ。バックプレーンの登録簿も同じキーなので、
+    # 相手探しはコースの数だけ参照すれば済み、待機している人数には依存しない。
+    # 期限切れはタイミングホイールで片付けるので、全体を走査することはない
+    def __init__(self, timeout=WAITING_TIMEOUT, tick=5.0):
+        self.timeout = timeout
+        self.buckets = server_status["waiting"]
+        self.wheel = TimingWheel(self.expire, tick, int(timeout // tick) + 2)
+
+    @staticmethod
+    def key(gameid, diff):
+        return json.dumps([gameid, diff], separators=(",", ":"))
+
+    def candidates(self, gameid, diff):
+        courses = COURSE_ORDER.get(diff)
+        if courses is None:
+            courses = (diff,) + COURSES
+        return [self.key(gameid, course) for course in courses]
+
+    def add(self, user, key):
+        waiting = WaitingEntry(user, key)
+        self.buckets[key] = waiting
+        self.wheel.schedule(waiting, self.timeout)
+
+    def remove(self, user):
+        waiting = self.buckets.get(self.key(user.gameid, user.diff))
+        if waiting is None or waiting.user is not user:
+            return None
+        del self.buckets[waiting.key]
+        self.wheel.cancel(waiting)
+        return waiting
+
+    def expire(self, waiting):
+        if self.buckets.get(waiting.key) is not waiting:
+            return
+        del self.buckets[waiting.key]
+        user = waiting.user
+        match_stats["expired"] += 1
+        background(release_entry("waiting", waiting.key, user.entry))
+        user.action = "ready"
+        user.gameid = None
+        user.entry = None
+        user.send(msgobj("gameend"))
+
+    def start(self):
+        self.wheel.start()
+
+    def stop(self):
+        self.wheel.stop()
+
+match_pool = MatchPool()
+
+async def start_matchmaking(app):
+    match_pool.start()
+
+async def stop_matchmaking(app):
+    match_pool.stop()
+
+def pair_join(other, user, diff):
+    match_stats["same" if other.diff == diff else "other"] += 1
+    match_pool.remove(other)
+    song = other.gameid
+    other.gameid = None
+    other.entry = None
+    user.gameid = None
+    user.diff = diff
+    Room(other, user, song)
+    user.action = "loading"
+    other.action = "loading"
+    user.send(msgobj("gameload", {"diff": other.diff, "player": 2}))
+    other.send(msgobj("gameload", {"diff": diff, "player": 1}))
+    user.send(name_event(other))
+    other.send(name_event(user))
+
+def pair_invite(other, user, invite):
+    if server_status["invites"].get(invite) is other:
+        del server_status["invites"][invite]
+    other.entry = None
+    Room(other, user)
+    user.action = "invite"
+    user.session = invite
+    user.send(msgobj("session", {"player": 2}))
+    other.send(msgobj("session", {"player": 1}))
+    user.send(msgobj("invite"))
+    user.send(name_event(other))
+    other.send(name_event(user))
+
+def attach_remote(user, info, kind, key):
+    # 相手のワーカーに「そちらのルームに入る」と伝え、以後のフレームはそこへ転送する
+    user.action = "remote"
+    user.proxy = info["worker"]
+    payload = registry_entry(user, kind=kind, id=key, diff=user.diff, name=user.name, don=user.don, binary=user.binary)
+    backplane.send(info["worker"], "A", info["conn"], payload)
+
+async def join_game(user, gameid, diff):
+    key = match_pool.key(gameid, diff)
+    candidates = match_pool.candidates(gameid, diff)
+    entry = registry_entry(user, id=gameid, diff=diff, time=int(time.time()))
+    user.gameid = gameid
+    user.diff = diff
+    while True:
+        other_entry = await backplane.claim("waiting", key, entry, candidates)
+        if user.ws is None:
+            # 登録中に切断された
+            if other_entry is None:
+                await backplane.release("waiting", key, entry)
+            else:
+                info = json.loads(other_entry)
+                await backplane.reserve("waiting", match_pool.key(info["id"], info["diff"]), other_entry)
+            return
+        if other_entry is None:
+            # 同じ曲の相手が来るまで待つ
+            user.action = "waiting"
+            user.entry = entry
+            match_pool.add(user, key)
+            user.send(msgobj("waiting"))
+            break
+        info = json.loads(other_entry)
+        if info["worker"] != backplane.worker_id:
+            attach_remote(user, info, "join", gameid)
+            break
+        other = server_status["users"].get(info["conn"])
+        if other is not None and other.action == "waiting":
+            pair_join(other, user, diff)
+            break
+        # 古い登録だったので取り直す
+    notify_status()
+
+async def create_invite(user):
+    entry = registry_entry(user)
+    invite = get_invite()
+    while not await backplane.reserve("invites", invite, entry):
+        invite = get_invite()
+    if user.ws is None:
+        await backplane.release("invites", invite, entry)
+        return
+    server_status["invites"][invite] = user
+    user.action = "invite"
+    user.session = invite
+    user.entry = entry
+    user.send(msgobj("invite", invite))
+
+async def join_invite(user, invite):
+    entry = await backplane.take("invites", invite)
+    if user.ws is None:
+        if entry is not None:
+            await backplane.reserve("invites", invite, entry)
+        return
+    if entry is not None:
+        info = json.loads(entry)
+        if info["worker"] != backplane.worker_id:
+            user.session = invite
+            attach_remote(user, info, "invite", invite)
+            return
+        other = server_status["users"].get(info["conn"])
+        if other is not None and other.action == "invite" and other.room is None:
+            pair_invite(other, user, invite)
+            return
+    # 招待コードが無効
+    user.action = "ready"
+    user.send(msgobj("gameend"))
+
+# ================================
+# フレーム処理（状態ごと）
+# ================================
+def on_ready(user, msg_type, value):
+    if not isinstance(value, dict):
+        return
+    if msg_type == "join":
+        # 同じ曲を選んだ相手を待つ、または待っている相手と対戦開始
+        gameid = value.get("id")
+        diff = value.get("diff")
+        user.name = value.get("name")
+        user.don = value.get("don")
+        if not valid_key(gameid) or not diff:
+            return
+        user.action = "joining"
+        matchmaking(user, join_game(user, gameid, diff))
+
+    elif msg_type == "spectate":
+        # 対戦中のルームを観戦する
+        room = server_status["rooms"].get(value.get("id"))
+        if room is None or len(room.spectators or ()) >= SPECTATOR_LIMIT:
+            user.send(msgobj("gameend"))
+            return
+        if room.spectators is None:
+            room.spectators = set()
+        room.spectators.add(user)
+        user.watching = room
+        user.action = "spectating"
+        user.send(msgobj("spectating", room.info()))
+
+    elif msg_type == "invite":
+        invite_id = value.get("id")
+        user.name = value.get("name")
+        user.don = value.get("don")
+        if "id" in value and invite_id is None:
+            # 招待リンクを発行して相手を待つ
+            user.action = "joining"
+            matchmaking(user, create_invite(user))
+        elif valid_key(invite_id):
+            # 招待したユーザーとセッションを始める
+            user.action = "joining"
+            matchmaking(user, join_invite(user, str(invite_id)))
+        else:
+            # 招待コードが無効
+            user.send(msgobj("gameend"))
+
+def on_waiting(user, msg_type, value):
+    if msg_type == "leave":
+        if user.session:
+            peer = user.peer
+            if peer is not None:
+                user.action = "songsel"
+                user.send(msgobj("left"))
+                peer.send(msgobj("users", []))
+            else:
+                user.action = "ready"
+                user.session = False
+                user.send(msgobj("gameend"))
+                user.send(status_event())
+        elif user.room is not None:
+            end_room(user, "left")
+        else:
+            match_pool.remove(user)
+            background(release_entry("waiting", match_pool.key(user.gameid, user.diff), user.entry))
+            user.gameid = None
+            user.entry = None
+            user.action = "ready"
+            user.send(msgobj("left"))
+
+    elif msg_type == "gamestart" and user.action == "loading":
+        # 両者の読み込みが終わったら開始
+        user.action = "loaded"
+        peer = user.peer
+        if peer is not None and peer.action == "loaded":
+            user.action = "playing"
+            peer.action = "playing"
+            msg = msgobj("gamestart")
+            user.send(msg)
+            peer.send(msg)
+            if user.room.spectators:
+                user.room.spectate(0, msg)
+            start_recording(user.room, msg)
+
+def on_playing(user, msg_type, value):
+    peer = user.peer
+    if peer is None:
+        # 相手が切断済み
+        user.action = "ready"
+        user.session = False
+        user.send(msgobj("gameend"))
+        user.send(status_event())
+    elif msg_type == "songsel" and user.session:
+        stop_recording(user.room)
+        user.action = "songsel"
+        peer.action = "songsel"
+        msg = msgobj("songsel")
+        users = msgobj("users", [])
+        for u in (user, peer):
+            u.send(msg)
+            u.send(users)
+    elif msg_type == "gameend":
+        end_room(user)
+
+def on_invite(user, msg_type, value):
+    if msg_type == "leave":
+        # 招待を取り消す
+        if server_status["invites"].get(user.session) is user:
+            del server_status["invites"][user.session]
+            background(release_entry("invites", user.session, user.entry, False))
+        if user.peer is not None:
+            end_room(user, "left")
+        else:
+            user.action = "ready"
+            user.session = False
+            user.send(msgobj("left"))
+            user.send(status_event())
+    elif msg_type == "songsel" and user.peer is not None:
+        peer = user.peer
+        user.action = "songsel"
+        peer.action = "songsel"
+        msg = msgobj("songsel")
+        user.send(msg)
+        peer.send(msg)
+
+def on_songsel(user, msg_type, value):
+    peer = user.peer
+    if peer is None:
+        user.action = "ready"
+        user.session = False
+        user.send(msgobj("gameend"))
+        user.send(status_event())
+    elif msg_type == "songsel" or msg_type == "catjump":
+        # 曲選択の位置を両者で同期する
+        if peer.action == "songsel" and isinstance(value, dict):
+            value["player"] = user.player
+            msg = msgobj(msg_type, value)
+            user.send(msg)
+            peer.send(msg)
+    elif msg_type == "join":
+        if not isinstance(value, dict) or not value.get("id") or not value.get("diff"):
+            return
+        if peer.action == "selected":
+            user.action = "loading"
+            peer.action = "loading"
+            user.diff = value["diff"]
+            user.send(msgobj("gameload", {"diff": peer.diff}))
+            peer.send(msgobj("gameload", {"diff": value["diff"]}))
+            room = user.room
+            room.song = value["id"]
+            if room.spectators:
+                room.spectate(0, msgobj("gameload", room.info()))
+        else:
+            user.action = "selected"
+            user.diff = value["diff"]
+    elif msg_type == "gameend":
+        end_room(user)
+
+def on_spectating(user, msg_type, value):
+    if msg_type == "leave":
+        unwatch(user)
+        user.action = "ready"
+        user.send(msgobj("left"))
+        user.send(status_event())
+
+ACTION_HANDLERS = {
+    "ready": on_ready,
+    "waiting": on_waiting,
+    "loading": on_waiting,
+    "loaded": on_waiting,
+    "playing": on_playing,
+    "invite": on_invite,
+    "songsel": on_songsel,
+    "selected": on_songsel,
+    "spectating": on_spectating
+}
+
+def handle_frame(user, data):
+    msg_type = frame_type(data)
+    count_frame(frame_stats["in"], msg_type)
+    if user.proxy is not None:
+        # ルームは別のワーカーにあるので、そのまま転送する
+        backplane.send(user.proxy, "F", "%s/%s" % (backplane.worker_id, user.id), data)
+        return
+    action = user.action
+    if msg_type in RELAY_TYPES and action == "playing" \
+            or msg_type in SONGSEL_RELAY_TYPES and action in ("songsel", "selected"):
+        # 相手の接続へそのまま流す（再エンコードしない）
+        peer = user.peer
+        if peer is not None:
+            peer.send(data)
+            frame_stats["relayed_bytes"] += len(data)
+            room = user.room
+            # 観戦者へのまとめと記録には検証したフレームだけを入れる
+            if action == "playing" and (room.spectators or room.recording is not None) and valid_frame(data):
+                if room.spectators:
+                    room.spectate(user.player, data)
+                if room.recording is not None:
+                    room.recording.frames.append((time.monotonic(), user.player, data))
+            return
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return
+    if not isinstance(obj, dict):
+        return
+    handler = ACTION_HANDLERS.get(action)
+    if handler is not None:
+        handler(user, obj.get("type"), obj.get("value"))
+
+def handle_binary(user, data):
+    count_frame(frame_stats["in"], BINARY_TYPES.get(data[0]) if data else None)
+    if user.proxy is not None:
+        backplane.send(user.proxy, "FB", "%s/%s" % (backplane.worker_id, user.id), data.decode("latin-1"))
+        return
+    if user.action != "playing" or not data or data[0] not in BINARY_TYPES:
+        return
+    peer = user.peer
+    if peer is None:
+        return
+    msg = None
+    if peer.binary:
+        # 中身を見ずにそのまま流す
+        peer.send(data)
+        frame_stats["relayed_bytes"] += len(data)
+    else:
+        msg = decode_binary(data)
+        if msg is None:
+            return
+        peer.send(msg)
+        frame_stats["relayed_bytes"] += len(msg)
+    room = user.room
+    if room.recording is not None:
+        room.recording.frames.append((time.monotonic(), user.player, data))
+    if room.spectators:
+        # 観戦者には JSON で送る
+        msg = msg or decode_binary(data)
+        if msg is not None:
+            room.spectate(user.player, msg)
+
+def disconnect(user):
+    if server_status["users"].pop(user.id, None) is None:
+        # ハートビートで片付け済み
+        return
+    heartbeat_wheel.cancel(user)
+    user.ws = None
+    if user.watching is not None:
+        unwatch(user)
+    if user.budget is not None:
+        release_budget(user.budget)
+        user.budget = None
+    user.queue = []
+    if user.proxy is not None:
+        backplane.send(user.proxy, "D", "%s/%s" % (backplane.worker_id, user.id))
+    if user.peer is not None:
+        end_room(user, None)
+    if user.action == "waiting":
+        match_pool.remove(user)
+        background(release_entry("waiting", match_pool.key(user.gameid, user.diff), user.entry))
+    elif user.action == "invite" and server_status["invites"].get(user.session) is user:
+        del server_status["invites"][user.session]
+        background(release_entry("invites", user.session, user.entry, False))
+
+# ================================
+# ハートビート
+# ================================
+def check_heartbeat(user):
+    if user.ws is None:
+        return
+    missed = user.missed
+    if missed > HEARTBEAT_MISSES:
+        reap(user)
+        return
+    if missed:
+        # 1間隔以上何も届いていないので ping で確かめる
+        heartbeat_stats["pings"] += 1
+        user.send(PING_FRAME)
+    user.missed = missed + 1
+    heartbeat_wheel.schedule(user, HEARTBEAT_INTERVAL)
+
+def reap(user):
+    # 応答の無い接続（電波が切れたスマホなど）を片付け、待機・招待の登録も消す
+    heartbeat_stats["reaped"] += 1
+    if user.transport is not None:
+        user.transport.abort()
+    disconnect(user)
+
+heartbeat_wheel = TimingWheel(check_heartbeat)
+
+async def start_heartbeat(app):
+    heartbeat_wheel.start()
+
+async def stop_heartbeat(app):
+    heartbeat_wheel.stop()
+
+# ================================
+# バックプレーンからのメッセージ
+# ================================
+def on_backplane(op, key, payload):
+    users = server_status["users"]
+    if op == "S":
+        # 別ワーカーのルームからこのワーカーの接続へ
+        user = users.get(int(key))
+        if user is not None:
+            user.send(payload)
+    elif op == "SB":
+        user = users.get(int(key))
+        if user is not None:
+            user.send(payload.encode("latin-1"))
+    elif op == "F":
+        # 別ワーカーの接続からこのワーカーのルームへ
+        remote = server_status["remote"].get(key)
+        if remote is not None:
+            handle_frame(remote, payload)
+    elif op == "FB":
+        remote = server_status["remote"].get(key)
+        if remote is not None:
+            handle_binary(remote, payload.encode("latin-1"))
+    elif op == "A":
+        attach(users.get(int(key)), json.loads(payload))
+    elif op == "R" or op == "X":
+        user = users.get(int(key))
+        if user is None or user.proxy is None:
+            return
+        user.proxy = None
+        if op == "X" and not user.session:
+            # 待っていた相手がもういなかったので探し直す
+            user.action = "joining"
+            matchmaking(user, join_game(user, user.gameid, user.diff))
+            return
+        user.action = "ready"
+        user.session = False
+        user.gameid = None
+        if op == "X":
+            user.send(msgobj("gameend"))
+    elif op == "D":
+        remote = server_status["remote"].get(key)
+        if remote is not None and remote.peer is not None:
+            end_room(remote, None)
+    elif op == "N":
+        if key != backplane.worker_id:
+            status_publisher.notify(local=False)
+
+def attach(other, info):
+    remote = RemoteConnection(info["worker"], info["conn"])
+    remote.name = info.get("name")
+    remote.don = info.get("don")
+    remote.binary = info.get("binary", False)
+    if info["kind"] == "join":
+        if other is None or other.action != "waiting" or other.gameid != info["id"]:
+            return backplane.send(remote.worker, "X", remote.id)
+        server_status["remote"][remote.key] = remote
+        pair_join(other, remote, info["diff"])
+        notify_status()
+    else:
+        if other is None or other.action != "invite" or other.room is not None or other.session != info["id"]:
+            return backplane.send(remote.worker, "X", remote.id)
+        server_status["remote"][remote.key] = remote
+        pair_invite(other, remote, info["id"])
+
+async def start_backplane(app):
+    await backplane.start(on_backplane)
+
+async def close_backplane(app):
+    await backplane.close()
 
 # ================================
 # WebSocket コネクション処理
 # ================================
 async def connection(request):
-    ws = web.WebSocketResponse()
+    # pong を受け取ってハートビートに使うため、ping / pong は自分で処理する
+    ws = web.WebSocketResponse(protocols=(BINARY_PROTOCOL,), compress=WS_DEFLATE, autoping=False)
     await ws.prepare(request)
 
-    user = {"ws": ws, "action": None}
-    server_status["users"].append(user)
-    await notify_status()
+    user = Connection(ws, request.transport)
+    user.binary = ws.ws_protocol == BINARY_PROTOCOL
+    user.control_bucket = TokenBucket(CONTROL_BUDGET)
+    user.note_bucket = TokenBucket(NOTE_BUDGET)
+    user.budget = address_budget(client_address(request))
+    server_status["users"][user.id] = user
+    heartbeat_wheel.schedule(user, HEARTBEAT_INTERVAL)
 
     try:
+        # 待機中のユーザーを知らせる
+        user.send(status_event())
         async for msg in ws:
+            user.missed = 0
             if msg.type == aiohttp.WSMsgType.TEXT:
-                try:
-                    data = json.loads(msg.data)
-                except:
-                    continue
-
-                action = data.get("action")
-
-                if action == "ready":
-                    gameid = data["gameid"]
-                    user["action"] = "waiting"
-                    user["gameid"] = gameid
-                    server_status["waiting"][gameid] = user
-                    await notify_status()
-
-                elif action == "invite":
-                    session = data["session"]
-                    user["action"] = "invite"
-                    user["session"] = session
-                    server_status["invites"][session] = user
-                    await notify_status()
-
-                elif action == "start":
-                    target = server_status["waiting"].get(data["gameid"])
-                    if target:
-                        msg = json.dumps({"type": "start"})
-                        await target["ws"].send_str(msg)
-                        await ws.send_str(msg)
-
-                elif action == "play":
-                    session = data.get("session")
-                    target = server_status["invites"].get(session)
-                    if target and "ws" in target:
-                        await target["ws"].send_str(json.dumps({
-                            "type": "play",
-                            "score": data.get("score"),
-                            "combo": data.get("combo")
-                        }))
+                data = msg.data
+                if allow_frame(user, frame_prefix(data) in RELAY_TYPES):
+                    handle_frame(user, data)
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                if allow_frame(user, True):
+                    handle_binary(user, msg.data)
+            elif msg.type == aiohttp.WSMsgType.PING:
+                await ws.pong(msg.data)
 
     except Exception as e:
         print("Error in websocket:", e)
         traceback.print_exc()
     finally:
-        if user in server_status["users"]:
-            server_status["users"].remove(user)
-        if user.get("action") == "waiting" and "gameid" in user:
-            gameid = user["gameid"]
-            if gameid in server_status["waiting"]:
-                del server_status["waiting"][gameid]
-        if user.get("action") == "invite" and "session" in user:
-            session = user["session"]
-            if session in server_status["invites"]:
-                del server_status["invites"][session]
-        await notify_status()
+        disconnect(user)
 
     return ws
 
+# ================================
+# メトリクス
+# ================================
+class LoopMonitor:
+    # 一定間隔のタイマーがどれだけ遅れて動いたかをヒストグラムにする。
+    # ループが止まっている間は別スレッドが気付き、その時点のスタックを出力する
+    def __init__(self, interval=LAG_SAMPLE_INTERVAL, threshold=BLOCK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.buckets = [0] * len(LAG_BUCKETS)
+        self.lag_sum = 0.0
+        self.lag_count = 0
+        self.blocked = 0
+        self.expected = None
+        self.last_tick = None
+        self.handle = None
+        self.loop_thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.stopped.clear()
+        self.schedule(loop)
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def schedule(self, loop):
+        self.last_tick = time.monotonic()
+        self.expected = loop.time() + self.interval
+        self.handle = loop.call_at(self.expected, self.tick, loop)
+
+    def tick(self, loop):
+        lag = max(0.0, loop.time() - self.expected)
+        self.lag_sum += lag
+        self.lag_count += 1
+        for i, bound in enumerate(LAG_BUCKETS):
+            if lag <= bound:
+                self.buckets[i] += 1
+        self.schedule(loop)
+
+    def watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            tick = self.last_tick
+            stalled = time.monotonic() - tick - self.interval
+            if stalled > self.threshold and reported != tick:
+                # 同じ停止は一度だけ報告する
+                reported = tick
+                self.blocked += 1
+                frame = sys._current_frames().get(self.loop_thread)
+                print("Event loop blocked for %.3fs:" % stalled)
+                if frame is not None:
+                    traceback.print_stack(frame)
+
+loop_monitor = LoopMonitor()
+
+def metrics_text():
+    users = server_status["users"].values()
+    depths = [len(user.queue) for user in users]
+    lines = [
+        '# TYPE taiko_worker_info gauge',
+        'taiko_worker_info{worker="%s"} 1' % backplane.worker_id,
+        '# TYPE taiko_backplane_reconnects_total counter',
+        'taiko_backplane_reconnects_total %d' % backplane.stats["reconnects"],
+        '# TYPE taiko_backplane_dropped_total counter',
+        'taiko_backplane_dropped_total %d' % backplane.stats["dropped"],
+        '# TYPE taiko_connections gauge',
+        'taiko_connections %d' % len(depths),
+        '# TYPE taiko_remote_connections gauge',
+        'taiko_remote_connections %d' % len(server_status["remote"]),
+        '# TYPE taiko_rooms gauge',
+        'taiko_rooms %d' % len(server_status["rooms"]),
+        '# TYPE taiko_waiting gauge',
+        'taiko_waiting %d' % len(server_status["waiting"]),
+        '# TYPE taiko_invites gauge',
+        'taiko_invites %d' % len(server_status["invites"]),
+        '# TYPE taiko_spectators gauge',
+        'taiko_spectators %d' % sum(len(room.spectators) for room in server_status["rooms"].values() if room.spectators),
+        '# TYPE taiko_spectate_batches_total counter',
+        'taiko_spectate_batches_total %d' % spectate_stats["batches"],
+        '# TYPE taiko_spectate_skipped_total counter',
+        'taiko_spectate_skipped_total %d' % spectate_stats["skipped"],
+        '# TYPE taiko_recordings_active gauge',
+        'taiko_recordings_active %d' % (len(recorder.active) if recorder else 0),
+        '# TYPE taiko_recordings_total counter',
+        'taiko_recordings_total %d' % (recorder.recordings if recorder else 0),
+        '# TYPE taiko_recorded_frames_total counter',
+        'taiko_recorded_frames_total %d' % (recorder.frames if recorder else 0),
+        '# TYPE taiko_recorded_bytes_total counter',
+        'taiko_recorded_bytes_total %d' % (recorder.bytes if recorder else 0),
+        '# TYPE taiko_matches_total counter',
+        'taiko_matches_total{course="same"} %d' % match_stats["same"],
+        'taiko_matches_total{course="other"} %d' % match_stats["other"],
+        '# TYPE taiko_waiting_expired_total counter',
+        'taiko_waiting_expired_total %d' % match_stats["expired"],
+        '# TYPE taiko_waiting_swept_total counter',
+        'taiko_waiting_swept_total %d' % match_stats["swept"],
+        '# TYPE taiko_send_queue_depth gauge',
+        'taiko_send_queue_depth %d' % sum(depths),
+        '# TYPE taiko_send_queue_depth_max gauge',
+        'taiko_send_queue_depth_max %d' % max(depths, default=0)
+    ]
+    for direction in ("in", "out"):
+        lines.append('# TYPE taiko_frames_%s_total counter' % direction)
+        for msg_type, count in sorted(frame_stats[direction].items()):
+            lines.append('taiko_frames_%s_total{type="%s"} %d' % (direction, msg_type, count))
+    lines += [
+        '# TYPE taiko_relayed_bytes_total counter',
+        'taiko_relayed_bytes_total %d' % frame_stats["relayed_bytes"],
+        '# TYPE taiko_sent_bytes_total counter',
+        'taiko_sent_bytes_total %d' % frame_stats["sent_bytes"],
+        '# TYPE taiko_send_dropped_total counter',
+        'taiko_send_dropped_total %d' % send_stats["dropped"],
+        '# TYPE taiko_send_kicked_total counter',
+        'taiko_send_kicked_total %d' % send_stats["kicked"],
+        '# TYPE taiko_status_broadcasts_total counter',
+        'taiko_status_broadcasts_total %d' % status_publisher.broadcasts,
+        '# TYPE taiko_status_coalesced_total counter',
+        'taiko_status_coalesced_total %d' % status_publisher.coalesced,
+        '# TYPE taiko_throttled_frames_total counter',
+        'taiko_throttled_frames_total{scope="connection",budget="control"} %d' % throttle_stats["control"],
+        'taiko_throttled_frames_total{scope="connection",budget="note"} %d' % throttle_stats["note"],
+        'taiko_throttled_frames_total{scope="address",budget="control"} %d' % throttle_stats["address_control"],
+        'taiko_throttled_frames_total{scope="address",budget="note"} %d' % throttle_stats["address_note"],
+        '# TYPE taiko_client_addresses gauge',
+        'taiko_client_addresses %d' % len(address_budgets),
+        '# TYPE taiko_heartbeat_pings_total counter',
+        'taiko_heartbeat_pings_total %d' % heartbeat_stats["pings"],
+        '# TYPE taiko_zombies_reaped_total counter',
+        'taiko_zombies_reaped_total %d' % heartbeat_stats["reaped"],
+        '# TYPE taiko_event_loop_blocked_total counter',
+        'taiko_event_loop_blocked_total %d' % loop_monitor.blocked,
+        '# TYPE taiko_event_loop_lag_seconds histogram'
+    ]
+    for bound, count in zip(LAG_BUCKETS, loop_monitor.buckets):
+        lines.append('taiko_event_loop_lag_seconds_bucket{le="%s"} %d' % (bound, count))
+    lines += [
+        'taiko_event_loop_lag_seconds_bucket{le="+Inf"} %d' % loop_monitor.lag_count,
+        'taiko_event_loop_lag_seconds_sum %.6f' % loop_monitor.lag_sum,
+        'taiko_event_loop_lag_seconds_count %d' % loop_monitor.lag_count
+    ]
+    return "\n".join(lines) + "\n"
+
+async def metrics(request):
+    return web.Response(text=metrics_text(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics(app):
+    loop_monitor.start()
+
+async def stop_metrics(app):
+    loop_monitor.stop()
+
+# ================================
+# 対戦の記録
+# ================================
+async def start_recorder(app):
+    if recorder is not None:
+        recorder.task = background(recorder.run())
+
+async def stop_recorder(app):
+    if recorder is not None:
+        recorder.task.cancel()
+        recorder.close()
+
+async def api_replays(request):
+    replays = []
+    try:
+        entries = list(os.scandir(RECORD_DIR))
+    except FileNotFoundError:
+        # まだ何も記録していない
+        entries = []
+    for entry in entries:
+        if entry.name.endswith(EXTENSION):
+            replays.append({"name": entry.name[:-len(EXTENSION)], "size": entry.stat().st_size})
+    replays.sort(key=lambda replay: replay["name"])
+    return web.json_response(replays, headers={"Cache-Control": "no-cache"})
+
+def replay_chunks(buf, header, pos, lines_per_chunk=256):
+    # 記録を lines_per_chunk フレームずつ ndjson のバイト列にする。デコードはスレッドで行う
+    lines = [json.dumps(header, separators=(",", ":")) + "\n"]
+    for ms, player, kind, payload in iter_records(buf, pos):
+        frame = replay_frame(kind, payload)
+        if frame is None:
+            continue
+        lines.append('{"ms":%d,"player":%d,"frame":%s}\n' % (ms, player, frame))
+        if len(lines) >= lines_per_chunk:
+            yield "".join(lines).encode("utf-8")
+            lines = []
+    if lines:
+        yield "".join(lines).encode("utf-8")
+
+async def api_replay(request):
+    # 記録を mmap で読みながら、1行1フレームの JSON で返す（?raw=1 ならファイルそのまま）
+    # 大きな記録でも対戦中のイベントループを止めないよう、フレームのデコードはスレッドで行う
+    name = request.match_info["name"]
+    if not REPLAY_NAME.match(name):
+        raise web.HTTPNotFound()
+    path = os.path.join(RECORD_DIR, name + EXTENSION)
+    if request.query.get("raw"):
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={"Content-Type": "application/octet-stream"})
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        raise web.HTTPNotFound()
+    with buf:
+        try:
+            header, pos = read_header(buf)
+        except (ValueError, IndexError):
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        chunks = replay_chunks(buf, header, pos)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            await response.write(chunk)
+    await response.write_eof()
+    return response
+
+# ================================
+# API レスポンスキャッシュ
+# ================================
+class CachedDocument:
+    # 内容と gzip / brotli 圧縮済みのバイト列、ETag を保持し、ファイルが変わったら作り直す
+    __slots__ = ("paths", "content_type", "build", "stamp", "entry")
+
+    def __init__(self, paths, content_type, build=None):
+        self.paths = paths
+        self.content_type = content_type
+        self.build = build or self.read
+        self.stamp = None
+        # (本文, gzip, brotli, ETag の元になるハッシュ)。ファイルが無いときは None
+        self.entry = None
+
+    def read(self):
+        with open(self.paths[0], "rb") as f:
+            return f.read()
+
+    def file_stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((st.st_mtime_ns, st.st_size))
+        return tuple(stamp)
+
+    def refresh(self):
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return False
+        if stamp[0] is None:
+            entry = None
+        else:
+            body = self.build()
+            entry = (
+                body,
+                gzip.compress(body, 9),
+                brotli.compress(body) if brotli is not None else None,
+                hashlib.sha256(body).hexdigest()[:32]
+            )
+        # スレッドから呼ばれても中途半端な状態が見えないよう一度に差し替える
+        self.entry = entry
+        self.stamp = stamp
+        return True
+
+    def response(self, request):
+        entry = self.entry
+        if entry is None:
+            raise web.HTTPNotFound()
+        body, gzipped, brotlied, digest = entry
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        # 強い ETag はバイト列ごとに別の値にする（圧縮の有無・方式で中身のバイト列が変わるため）
+        encodings = accepted_encodings(request.headers.get("Accept-Encoding"))
+        if brotlied is not None and "br" in encodings:
+            body = brotlied
+            headers["Content-Encoding"] = "br"
+            etag = '"%s-br"' % digest
+        elif "gzip" in encodings:
+            body = gzipped
+            headers["Content-Encoding"] = "gzip"
+            etag = '"%s-gz"' % digest
+        else:
+            etag = '"%s"' % digest
+        headers["ETag"] = etag
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            headers.pop("Content-Encoding", None)
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=self.content_type, charset="utf-8", headers=headers)
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag == etag or tag.startswith("W/") and tag[2:] == etag:
+            return True
+    return False
+
+def accepted_encodings(header):
+    encodings = set()
+    for item in (header or "").split(","):
+        name, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+async def start_documents(app):
+    documents = app["documents"].values()
+    for document in documents:
+        document.refresh()
+    app["document_watcher"] = asyncio.ensure_future(watch_documents(documents))
+
+async def stop_documents(app):
+    app["document_watcher"].cancel()
+
+async def watch_documents(documents):
+    # mtime を定期的に確認し、変わったものだけ別スレッドで作り直す（圧縮でループを止めないため）
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(FILE_POLL_INTERVAL)
+        for document in documents:
+            if document.file_stamp() != document.stamp:
+                try:
+                    await loop.run_in_executor(None, document.refresh)
+                except Exception as e:
+                    print("Error reloading %s:" % document.paths[0], e)
+
 # ================================
 # Web アプリ起動
 # ================================
-def main():
+async def create_app():
     app = web.Application()
+    app.on_startup.append(start_backplane)
+    app.on_cleanup.append(close_backplane)
+    app.on_startup.append(start_documents)
+    app.on_cleanup.append(stop_documents)
+    app.on_startup.append(start_metrics)
+    app.on_cleanup.append(stop_metrics)
+    app.on_startup.append(start_heartbeat)
+    app.on_cleanup.append(stop_heartbeat)
+    app.on_startup.append(start_matchmaking)
+    app.on_cleanup.append(stop_matchmaking)
+    app.on_startup.append(start_recorder)
+    app.on_cleanup.append(stop_recorder)
 
     # Jinja2 設定
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates'))
 
-    # index.html をレンダリング
-    @aiohttp_jinja2.template('index.html')
-    async def index(request):
+    # index.html は config.json かテンプレートが変わったときだけレンダリングする
+    def render_index():
         with open('./api/config.json', encoding='utf-8') as f:
             config = json.load(f)
         version = config.get("_version", {})
-        return {"version": version, "config": config}
+        template = aiohttp_jinja2.get_env(app).get_template('index.html')
+        return template.render(version=version, config=config).encode("utf-8")
+
+    documents = app["documents"] = {
+        "index": CachedDocument(["./api/config.json", "./templates/index.html"], "text/html", render_index),
+        "config": CachedDocument(["./api/config.json"], "application/json"),
+        "categories": CachedDocument(["./api/categories.json"], "application/json"),
+        "genres": CachedDocument(["./api/genres.json"], "application/json"),
+        "songs": CachedDocument(["./api/songs.json"], "application/json")
+    }
+
+    async def index(request):
+        return documents["index"].response(request)
 
     # API: config.json
     async def api_config(request):
-        return web.FileResponse("./api/config.json")
+        return documents["config"].response(request)
 
     # API: categories.json
     async def api_categories(request):
-        return web.FileResponse("./api/categories.json")
+        return documents["categories"].response(request)
 
     # API: genres.json
     async def api_genres(request):
-        return web.FileResponse("./api/genres.json")
+        return documents["genres"].response(request)
 
     # API: songs.json
     async def api_songs(request):
-        return web.FileResponse("./api/songs.json")
+        return documents["songs"].response(request)
+
+    # API: 観戦できるルーム（このワーカーのもの）
+    async def api_rooms(request):
+        rooms = [room.info() for room in server_status["rooms"].values()]
+        return web.json_response({"worker": backplane.worker_id, "rooms": rooms}, headers={"Cache-Control": "no-cache"})
 
     async def disable_judge_scores(request):
         return web.FileResponse("./disable-judge-scores.taikoweb.js")
@@ -141,12 +1757,18 @@ def main():
     # ================================
     app.router.add_get("/", index)
     app.router.add_get("/ws", connection)
+    app.router.add_get("/p2", connection)
     app.router.add_get("/healthcheck", lambda r: web.Response(text="OK"))
+    app.router.add_get("/metrics", metrics)
 
     app.router.add_get("/api/config", api_config)
     app.router.add_get("/api/categories", api_categories)
     app.router.add_get("/api/genres", api_genres)
     app.router.add_get("/api/songs", api_songs)
+    app.router.add_get("/api/rooms", api_rooms)
+    if recorder is not None:
+        app.router.add_get("/api/replays", api_replays)
+        app.router.add_get("/api/replays/{name}", api_replay)
 
     app.router.add_static('/api/', path='./api/', show_index=False)
     app.router.add_static('/src/', path='./src/', show_index=False)
@@ -154,9 +1776,11 @@ def main():
     app.router.add_static('/plugins/', path='./plugins/', show_index=False)
     app.router.add_static('/songs/', path='./songs/', show_index=False)
     app.router.add_get("/disable-judge-scores.taikoweb.js", disable_judge_scores)
+    return app
 
+def main():
     port = int(os.environ.get("PORT", 8080))
-    web.run_app(app, host="0.0.0.0", port=port)
+    web.run_app(create_app(), host="0.0.0.0", port=port)
 
 if __name__ == "__main__":
     main()
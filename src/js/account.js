@@ -386,6 +386,7 @@ class Account{
 			account.username = response.username
 			account.displayName = response.display_name
 			account.don = response.don
+			localStorage.removeItem("accountScores")
 			var loadScores = scores => {
 				scoreStorage.load(scores)
 				this.onEnd(false, true, true)
@@ -443,6 +444,7 @@ class Account{
 		delete account.username
 		delete account.displayName
 		delete account.don
+		localStorage.removeItem("accountScores")
 		var loadScores = () => {
 			scoreStorage.load()
 			this.onEnd(false, true)
@@ -488,6 +490,7 @@ class Account{
 				delete account.username
 				delete account.displayName
 				delete account.don
+				localStorage.removeItem("accountScores")
 				scoreStorage.load()
 				pageEvents.send("logout")
 				return Promise.resolve
@@ -189,8 +189,9 @@ for (let selector in assets.cssBackground) {
 			style.appendChild(document.createTextNode(css.join("\n")))
 			document.head.appendChild(style)
 
-			this.addPromise(this.ajax("/api/songs").then(songs => {
-				songs = JSON.parse(songs)
+			var catalog = this.loadCatalog()
+			this.addPromise(this.ajax("/api/songs?since=" + (catalog ? catalog.version : 0)).then(response => {
+				var songs = this.updateCatalog(catalog, JSON.parse(response))
 				songs.forEach(song => {
 					var directory = gameConfig.songs_baseurl + song.id + "/"
 					var songExt = song.music_type ? song.music_type : "mp3"
@@ -272,14 +273,21 @@ for (let selector in assets.cssBackground) {
 			}), "blurPerformance")
 
 			if(gameConfig.accounts){
-				this.addPromise(this.ajax("/api/scores/get").then(response => {
-					response = JSON.parse(response)
+				var accountScores = this.loadAccountScores()
+				this.addPromise(this.getAccountScores(accountScores).then(response => {
+					if(response.status === "ok" && !response.full && (!accountScores || accountScores.username !== response.username)){
+						// 保存していたスコアは別のアカウントのものなので、差分ではなく全件を取り直す
+						accountScores = null
+						return this.getAccountScores(null)
+					}
+					return response
+				}).then(response => {
 					if(response.status === "ok"){
 						account.loggedIn = true
 						account.username = response.username
 						account.displayName = response.display_name
 						account.don = response.don
-						scoreStorage.load(response.scores)
+						scoreStorage.load(this.updateAccountScores(accountScores, response))
 						pageEvents.send("login", account.username)
 					}
 				}), "/api/scores/get")
@@ -477,6 +485,68 @@ for (let selector in assets.cssBackground) {
 		}
 		return css.join("\n")
 	}
+	loadCatalog(){
+		try{
+			var catalog = JSON.parse(localStorage.getItem("songCatalog"))
+			if(catalog && catalog.version && Array.isArray(catalog.songs)){
+				return catalog
+			}
+		}catch(e){}
+		return null
+	}
+	updateCatalog(catalog, delta){
+		// 前回の曲一覧に、サーバーから届いた差分（追加・変更・削除）を適用する
+		if(Array.isArray(delta)){
+			// 差分に対応していないサーバー（server.py の songs.json など）は一覧をそのまま返す
+			try{
+				localStorage.removeItem("songCatalog")
+			}catch(e){}
+			return delta
+		}
+		var songs
+		if(delta.full || !catalog){
+			songs = delta.songs
+		}else{
+			var changed = {}
+			delta.removed.forEach(id => { changed[id] = true })
+			delta.songs.forEach(song => { changed[song.id] = true })
+			songs = catalog.songs.filter(song => !(song.id in changed)).concat(delta.songs)
+		}
+		try{
+			localStorage.setItem("songCatalog", JSON.stringify({version: delta.version, songs: songs}))
+		}catch(e){}
+		return songs
+	}
+	loadAccountScores(){
+		try{
+			var accountScores = JSON.parse(localStorage.getItem("accountScores"))
+			if(accountScores && accountScores.sync && accountScores.scores){
+				return accountScores
+			}
+		}catch(e){}
+		return null
+	}
+	getAccountScores(accountScores){
+		return this.ajax("/api/scores/get" + (accountScores ? "?since=" + accountScores.sync : "")).then(response => JSON.parse(response))
+	}
+	updateAccountScores(accountScores, response){
+		// 前回までのスコアに、前回の同期以降に保存されたスコアを重ねる
+		var scores = {}
+		if(!response.full && accountScores && accountScores.username === response.username){
+			scores = accountScores.scores
+		}
+		response.scores.forEach(score => {
+			scores[score.hash] = score.score
+		})
+		try{
+			localStorage.setItem("accountScores", JSON.stringify({username: response.username, sync: response.sync, scores: scores}))
+		}catch(e){}
+		var output = []
+		for(var hash in scores){
+			output.push({hash: hash, score: scores[hash]})
+		}
+		return output
+	}
 	ajax(url, customRequest, customResponse){
     return new Promise((resolve, reject) => {
         var request = new XMLHttpRequest()
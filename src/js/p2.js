@@ -12,6 +12,7 @@ class P2Connection{
 		this.addEventListener("message", this.message.bind(this))
 		this.currentHash = ""
 		this.disabled = 0
+		this.binaryProtocol = true
 		pageEvents.add(window, "hashchange", this.onhashchange.bind(this))
 	}
 	addEventListener(type, callback){
@@ -32,11 +33,16 @@ class P2Connection{
 		if(this.closed && !this.disabled){
 			this.closed = false
 			var wsProtocol = location.protocol == "https:" ? "wss:" : "ws:"
-			this.socket = new WebSocket(gameConfig.multiplayer_url ? gameConfig.multiplayer_url : wsProtocol + "//" + location.host + "/p2")
+			var protocols = this.binaryProtocol ? ["taiko-bin"] : []
+			this.socket = new WebSocket(gameConfig.multiplayer_url ? gameConfig.multiplayer_url : wsProtocol + "//" + location.host + "/p2", protocols)
+			this.socket.binaryType = "arraybuffer"
 			pageEvents.race(this.socket, "open", "close").then(response => {
 				if(response.type === "open"){
 					return this.openEvent()
 				}
+				// taiko-bin を返さないサーバー（古いものや外部のもの）にはブラウザが接続しないので、
+				// つながらなかったときは次の再接続でサブプロトコルの有無を切り替える
+				this.binaryProtocol = !protocols.length
 				return this.closeEvent()
 			})
 			pageEvents.add(this.socket, "message", this.messageEvent.bind(this))
@@ -79,7 +85,10 @@ class P2Connection{
 	}
 	send(type, value){
 		if(this.socket.readyState === this.socket.OPEN){
-			if(typeof value === "undefined"){
+			var binary = this.socket.protocol === "taiko-bin" && this.encodeBinary(type, value)
+			if(binary){
+				this.socket.send(binary)
+			}else if(typeof value === "undefined"){
 				this.socket.send(JSON.stringify({type: type}))
 			}else{
 				this.socket.send(JSON.stringify({type: type, value: value}))
@@ -90,9 +99,72 @@ class P2Connection{
 			})
 		}
 	}
+	encodeBinary(type, value){
+		if(type === "note"){
+			if(!Number.isInteger(value.score) || value.score < -32768 || value.score > 32767){
+				return false
+			}
+			var view = new DataView(new ArrayBuffer(8))
+			var flags = 0
+			view.setUint8(0, 1)
+			view.setInt16(1, value.score)
+			if("ms" in value){
+				view.setFloat32(3, value.ms)
+				flags = 8 | (value.dai & 3)
+			}
+			if(value.reverse){
+				flags |= 4
+			}
+			view.setUint8(7, flags)
+			return view.buffer
+		}else if(type === "drumroll"){
+			var view = new DataView(new ArrayBuffer(9))
+			view.setUint8(0, 2)
+			view.setFloat32(1, value.pace)
+			view.setFloat32(5, "kaAmount" in value ? value.kaAmount : NaN)
+			return view.buffer
+		}else if(type === "branch"){
+			var index = ["normal", "advanced", "master"].indexOf(value)
+			if(index === -1){
+				return false
+			}
+			return new Uint8Array([3, index]).buffer
+		}
+		return false
+	}
+	decodeBinary(buffer){
+		var view = new DataView(buffer)
+		switch(view.getUint8(0)){
+			case 1:
+				var flags = view.getUint8(7)
+				var value = {score: view.getInt16(1)}
+				if(flags & 8){
+					value.ms = view.getFloat32(3)
+					value.dai = flags & 3
+				}
+				if(flags & 4){
+					value.reverse = true
+				}
+				return {type: "note", value: value}
+			case 2:
+				var value = {pace: view.getFloat32(1)}
+				var kaAmount = view.getFloat32(5)
+				if(!isNaN(kaAmount)){
+					value.kaAmount = kaAmount
+				}
+				return {type: "drumroll", value: value}
+			case 3:
+				return {type: "branch", value: ["normal", "advanced", "master"][view.getUint8(1)]}
+		}
+		return {}
+	}
 	messageEvent(event){
 		try{
-			var response = JSON.parse(event.data)
+			if(event.data instanceof ArrayBuffer){
+				var response = this.decodeBinary(event.data)
+			}else{
+				var response = JSON.parse(event.data)
+			}
 		}catch(e){
 			var response = {}
 		}
@@ -1191,6 +1191,12 @@ var translations = {
 			en: "Security token expired. Please refresh the page.",
 			tw: "安全權杖過期。請重新載入頁面。",
 			ko: "보안 토큰이 만료되었습니다. 페이지를 새로고침해주세요."
+		},
+		server_busy: {
+			ja: "サーバーが混み合っています。しばらくしてからもう一度お試しください。",
+			en: "The server is busy. Please try again in a moment.",
+			tw: "伺服器忙碌中，請稍後再試。",
+			ko: "서버가 혼잡합니다. 잠시 후 다시 시도해주세요."
 		}
 	},
 	browserSupport: {
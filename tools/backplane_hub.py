@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Minimal Redis-protocol stand-in for the multiplayer backplane.
+# Serves the handful of commands backplane.RedisBackplane uses over a UNIX socket,
+# so several server.py workers can share waiting/invite registries without Redis.
+
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+from backplane import CLAIM_SCRIPT, TAKE_SCRIPT, RELEASE_SCRIPT, BackplaneError
+
+
+def encode_reply(value):
+    if value is None:
+        return b'$-1\r\n'
+    elif isinstance(value, bool):
+        return b':%d\r\n' % int(value)
+    elif isinstance(value, int):
+        return b':%d\r\n' % value
+    elif isinstance(value, BackplaneError):
+        return b'-%s\r\n' % str(value).encode('utf-8')
+    elif isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+    value = value.encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class Hub:
+    def __init__(self):
+        self.hashes = {}
+        self.channels = {}
+        self.scripts = {}
+
+    def claim(self, key, field, entry, *candidates):
+        registry = self.hashes.setdefault(key, {})
+        for candidate in candidates:
+            other = registry.pop(candidate, None)
+            if other is not None:
+                return other
+        registry[field] = entry
+        return None
+
+    def take(self, key, field):
+        return self.hashes.setdefault(key, {}).pop(field, None)
+
+    def release(self, key, field, entry):
+        registry = self.hashes.setdefault(key, {})
+        if registry.get(field) == entry:
+            del registry[field]
+            return 1
+        return 0
+
+    def load_script(self, script):
+        handlers = {CLAIM_SCRIPT: self.claim, TAKE_SCRIPT: self.take, RELEASE_SCRIPT: self.release}
+        if script not in handlers:
+            return BackplaneError('ERR unsupported script')
+        sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        self.scripts[sha] = handlers[script]
+        return sha
+
+    def execute(self, args, writer):
+        command = args[0].upper()
+        if command in ('AUTH', 'SELECT'):
+            return 'OK'
+        elif command == 'PING':
+            return 'PONG'
+        elif command == 'SCRIPT' and args[1].upper() == 'LOAD':
+            return self.load_script(args[2])
+        elif command == 'EVALSHA':
+            handler = self.scripts.get(args[1])
+            if handler is None:
+                return BackplaneError('NOSCRIPT No matching script')
+            numkeys = int(args[2])
+            return handler(*args[3:3 + numkeys], *args[3 + numkeys:])
+        elif command == 'HSETNX':
+            registry = self.hashes.setdefault(args[1], {})
+            if args[2] in registry:
+                return 0
+            registry[args[2]] = args[3]
+            return 1
+        elif command == 'HGETALL':
+            flat = []
+            for field, value in self.hashes.get(args[1], {}).items():
+                flat += [field, value]
+            return flat
+        elif command == 'PUBLISH':
+            subscribers = self.channels.get(args[1], ())
+            data = encode_reply(['message', args[1], args[2]])
+            for subscriber in subscribers:
+                subscriber.write(data)
+            return len(subscribers)
+        elif command == 'SUBSCRIBE':
+            replies = []
+            for count, channel in enumerate(args[1:], 1):
+                self.channels.setdefault(channel, set()).add(writer)
+                replies.append(encode_reply(['subscribe', channel, count]))
+            return replies
+        return BackplaneError('ERR unknown command %s' % command)
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for i in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode('utf-8'))
+                reply = self.execute(args, writer)
+                if isinstance(reply, list) and reply and isinstance(reply[0], bytes):
+                    writer.write(b''.join(reply))
+                else:
+                    writer.write(encode_reply(reply))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+async def main(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    hub = Hub()
+    server = await asyncio.start_unix_server(hub.serve, path=path)
+    print('Backplane hub listening on unix://%s' % path)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a Redis-protocol stand-in for the multiplayer backplane.')
+    parser.add_argument('path', nargs='?', default='/tmp/taiko-backplane.sock', help='UNIX socket path to listen on')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.path))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Cross-worker hop latency benchmark for the multiplayer backplane
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import backplane
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args):
+    url = args.url
+    hub = backplane.MemoryHub()
+    if url.startswith('memory:'):
+        a = backplane.MemoryBackplane(hub)
+        b = backplane.MemoryBackplane(hub)
+    else:
+        a = backplane.create_backplane(url)
+        b = backplane.create_backplane(url)
+
+    frame = '{"type":"note","value":{"score":450,"ms":-12.5,"dai":2}}'
+    received = asyncio.Queue()
+
+    def on_a(op, key, payload):
+        received.put_nowait(time.perf_counter())
+
+    def on_b(op, key, payload):
+        # Worker B holds the peer socket: bounce the frame straight back
+        b.send(a.worker_id, 'S', key, payload)
+
+    await a.start(on_a)
+    await b.start(on_b)
+    await asyncio.sleep(0.1)
+
+    hops = []
+    for i in range(args.count):
+        start = time.perf_counter()
+        a.send(b.worker_id, 'F', i, frame)
+        end = await received.get()
+        hops.append((end - start) / 2 * 1e6)
+
+    start = time.perf_counter()
+    for i in range(args.count):
+        a.send(b.worker_id, 'F', i, frame)
+    for i in range(args.count):
+        await received.get()
+    elapsed = time.perf_counter() - start
+
+    await a.close()
+    await b.close()
+
+    hops.sort()
+    print('backplane:  %s' % url)
+    print('hop (us):   p50 %.1f  p95 %.1f  p99 %.1f  max %.1f' % (
+        percentile(hops, 50), percentile(hops, 95), percentile(hops, 99), hops[-1]))
+    print('pipelined:  %.0f round trips/s' % (args.count / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cross-worker hop latency.')
+    parser.add_argument('--url', default='memory://', help='Backplane URL (memory://, redis://..., unix:///...)')
+    parser.add_argument('--count', type=int, default=5000, help='Round trips to measure')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Bytes-per-game and CPU-per-frame comparison of JSON and binary note relay
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import server
+from bench_relay import make_room, drain
+
+
+def game_frames(notes, drumrolls, branches):
+    # Roughly what src/js/game.js sends during one song
+    rng = random.Random(1)
+    frames = []
+    for i in range(notes):
+        if rng.random() < 0.03:
+            frames.append(('note', {'score': -1}))
+            continue
+        value = {'score': rng.choice([450, 450, 450, 230, 0]), 'ms': round(rng.uniform(-75, 75), 3), 'dai': rng.choice([0, 0, 0, 1, 2])}
+        if rng.random() < 0.01:
+            value['reverse'] = True
+        frames.append(('note', value))
+    for i in range(drumrolls):
+        frames.append(('drumroll', {'pace': round(rng.uniform(40, 90), 3), 'kaAmount': round(rng.random(), 3)}))
+    for i in range(branches):
+        frames.append(('branch', rng.choice(server.BRANCH_NAMES)))
+    return frames
+
+
+def js_json(msg_type, value):
+    # JSON.stringify output, as sent by p2.js
+    return json.dumps({'type': msg_type, 'value': value}, separators=(',', ':'))
+
+
+def deflate_size(payloads):
+    # permessage-deflate with context takeover: sync flush per message, 4-byte tail stripped
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    total = 0
+    for payload in payloads:
+        total += len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def wire_size(payloads):
+    # client -> server frames carry a 2-byte header and a 4-byte mask, server -> client only the header
+    total = 0
+    for payload in payloads:
+        header = 2 if len(payload) < 126 else 4
+        total += len(payload) * 2 + header * 2 + 4
+    return total
+
+
+async def timeit(fn, frames, chunk=128):
+    # Time in chunks below SEND_QUEUE_LIMIT and let the writers drain in between
+    elapsed = 0
+    for i in range(0, len(frames), chunk):
+        start = time.perf_counter()
+        for data in frames[i:i + chunk]:
+            fn(data)
+        elapsed += time.perf_counter() - start
+        await drain()
+    return elapsed / len(frames) * 1e6
+
+
+async def run(args):
+    frames = game_frames(args.notes, args.drumrolls, args.branches)
+    json_frames = [js_json(t, v).encode('utf-8') for t, v in frames]
+    binary_frames = [server.encode_binary(t, v) for t, v in frames]
+    assert all(binary_frames)
+
+    print('frames per player per game: %d' % len(frames))
+    print('%-24s %10s %10s %10s' % ('bytes per game', 'payload', 'wire', 'deflate'))
+    for name, payloads in (('json', json_frames), ('binary', binary_frames)):
+        print('%-24s %10d %10d %10d' % (name, sum(map(len, payloads)), wire_size(payloads), deflate_size(payloads)))
+
+    await server.start_backplane(None)
+    p1, p2 = await make_room('bench')
+    p1.binary = p2.binary = True
+    json_text = [data.decode('utf-8') for data in json_frames]
+    frames_x = (json_text * (args.repeat // len(json_text) + 1))[:args.repeat]
+    binary_x = (binary_frames * (args.repeat // len(binary_frames) + 1))[:args.repeat]
+
+    def legacy(data):
+        # Decode and re-encode every frame, as the ad-hoc handler did
+        obj = json.loads(data)
+        p2.send(server.msgobj(obj['type'], obj.get('value')))
+
+    print('%-24s %10s' % ('cpu per frame', 'us'))
+    results = [
+        ('json decode+encode', lambda data: legacy(data), frames_x),
+        ('json opaque relay', lambda data: server.handle_frame(p1, data), frames_x),
+        ('binary opaque relay', lambda data: server.handle_binary(p1, data), binary_x),
+    ]
+    for name, fn, batch in results:
+        print('%-24s %10.2f' % (name, await timeit(fn, batch)))
+    p2.binary = False
+    print('%-24s %10.2f' % ('binary -> json peer', await timeit(lambda data: server.handle_binary(p1, data), binary_x)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare JSON and binary note frames.')
+    parser.add_argument('--notes', type=int, default=800, help='Notes per game')
+    parser.add_argument('--drumrolls', type=int, default=15, help='Drumroll frames per game')
+    parser.add_argument('--branches', type=int, default=6, help='Branch frames per game')
+    parser.add_argument('--repeat', type=int, default=200000, help='Frames to time per case')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Sends a burst of logins at passwords.PasswordHasher from as many threads as a gunicorn
+# worker serves (--threads) and reports how many were admitted, how many got PasswordBusy
+# and how long admitted ones waited for the pool. Exits with an error if a burst that fills
+# every thread never gets PasswordBusy, since that means request threads pile up on bcrypt.
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import passwords
+
+
+def main(args):
+    try:
+        import config
+        options = dict(getattr(config, 'PASSWORD_HASHING', None) or {})
+    except ImportError:
+        options = {}
+    options['threads'] = args.threads
+    if args.rounds:
+        options['rounds'] = args.rounds
+    hasher = passwords.PasswordHasher(**options)
+    # Start the pool before timing, like a worker that has served a login already
+    hashed = hasher.hash(b'password')
+
+    results = {'ok': 0, 'busy': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def login():
+        barrier.wait()
+        try:
+            hasher.check(b'password', hashed)
+            result = 'ok'
+        except passwords.PasswordBusy:
+            result = 'busy'
+        with lock:
+            results[result] += 1
+
+    calls = hasher.stats['calls']
+    start = time.perf_counter()
+    for i in range(args.bursts):
+        threads = [threading.Thread(target=login) for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    print('workers %d, queue %d, threads %d, rounds %d' % (hasher.workers, hasher.queue, args.threads, hasher.rounds))
+    print('%d bursts in %.2f s: %d admitted, %d busy' % (args.bursts, elapsed, results['ok'], results['busy']))
+    admitted = hasher.stats['calls'] - calls
+    if admitted:
+        print('pool wait: mean %.1f ms, max %.1f ms' % (
+            hasher.stats['wait'] / hasher.stats['calls'] * 1000, hasher.stats['max_wait'] * 1000))
+    if not results['busy']:
+        print('No request got PasswordBusy: workers + queue is not below --threads')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check password hashing admission under a burst of logins.')
+    parser.add_argument('--threads', type=int, default=passwords.DEFAULT_THREADS, help='Request threads per app worker (gunicorn --threads)')
+    parser.add_argument('--bursts', type=int, default=5, help='Bursts of --threads simultaneous logins')
+    parser.add_argument('--rounds', type=int, help='bcrypt cost (default: from config.py)')
+    main(parser.parse_args())
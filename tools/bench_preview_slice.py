@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Compares Ogg page slicing (oggindex.py) with encoding a preview through ffmpeg
+# (previews.py) for every main.ogg in a songs directory: time to first byte, bytes
+# sent and extra disk used per song. Slices are previews.PREVIEW_LENGTH seconds long,
+# ffmpeg previews run from the preview offset to the end of the song.
+# Exits with an error when ffmpeg is not installed, unless --no-ffmpeg is given.
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+import oggindex
+import previews
+
+
+def preview_offset(song_dir, default):
+    # DEMOSTART from main.tja, like the preview offset stored for TJA songs
+    try:
+        with open(os.path.join(song_dir, 'main.tja'), encoding='utf-8-sig', errors='replace') as f:
+            for line in f:
+                if line.startswith('DEMOSTART:'):
+                    return float(line.split(':', 1)[1].strip() or default)
+    except (OSError, ValueError):
+        pass
+    return default
+
+
+def time_slice(path, seconds, runs):
+    oggindex.cache.clear()
+    start = time.perf_counter()
+    index = oggindex.get_index(path)
+    build = time.perf_counter() - start
+
+    # Warm index: what every request after the first one pays
+    ttfb = []
+    for i in range(runs):
+        start = time.perf_counter()
+        chunks = oggindex.iter_slice(oggindex.get_index(path), seconds, previews.PREVIEW_LENGTH)
+        next(chunks)
+        next(chunks)
+        ttfb.append(time.perf_counter() - start)
+        chunks.close()
+    return build, min(ttfb), index.slice_size(seconds, previews.PREVIEW_LENGTH), len(index.offsets)
+
+
+def time_ffmpeg(path, seconds, tmp_dir):
+    prev_path = os.path.join(tmp_dir, 'preview.ogg')
+    start = time.perf_counter()
+    previews.make_preview(path, prev_path, seconds, 'ogg')
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(prev_path)
+    os.remove(prev_path)
+    return elapsed, size
+
+
+def main(args):
+    paths = sorted(glob.glob(os.path.join(args.song_dir, '*', 'main.ogg')))
+    use_ffmpeg = not args.no_ffmpeg
+    print('%-10s %7s %6s %10s %10s %10s %12s %12s' % (
+        'song', 'offset', 'pages', 'index ms', 'ttfb us', 'slice KiB', 'ffmpeg ms', 'ffmpeg KiB'))
+    totals = {'build': 0.0, 'ttfb': 0.0, 'slice': 0, 'ffmpeg': 0.0, 'disk': 0}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for path in paths:
+            song_dir = os.path.dirname(path)
+            seconds = preview_offset(song_dir, args.seconds)
+            build, ttfb, size, pages = time_slice(path, seconds, args.runs)
+            totals['build'] += build
+            totals['ttfb'] += ttfb
+            totals['slice'] += size
+            if use_ffmpeg:
+                ffmpeg, disk = time_ffmpeg(path, seconds, tmp_dir)
+                totals['ffmpeg'] += ffmpeg
+                totals['disk'] += disk
+                ffmpeg_columns = '%12.1f %12.1f' % (ffmpeg * 1000, disk / 1024)
+            else:
+                ffmpeg_columns = '%12s %12s' % ('-', '-')
+            print('%-10s %7.1f %6d %10.2f %10.1f %10.1f %s' % (
+                os.path.basename(song_dir), seconds, pages, build * 1000, ttfb * 1e6, size / 1024, ffmpeg_columns))
+
+    if paths:
+        count = len(paths)
+        print('mean: index %.2f ms once per song, slice ttfb %.1f us, %.1f KiB sent, 0 bytes extra disk' % (
+            totals['build'] / count * 1000, totals['ttfb'] / count * 1e6, totals['slice'] / count / 1024))
+        if use_ffmpeg:
+            print('      ffmpeg ttfb %.1f ms, %.1f KiB sent and kept on disk per song' % (
+                totals['ffmpeg'] / count * 1000, totals['disk'] / count / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Ogg preview slicing against ffmpeg encoding.')
+    parser.add_argument('song_dir', nargs='?', default=os.path.join(parent_dir, 'songs'), help='Songs directory (default: songs/)')
+    parser.add_argument('--seconds', type=float, default=30, help='Preview offset when main.tja has no DEMOSTART')
+    parser.add_argument('--runs', type=int, default=20, help='Warm slice requests per song (best is reported)')
+    parser.add_argument('--no-ffmpeg', action='store_true', help='Skip the ffmpeg comparison')
+    args = parser.parse_args()
+    if not args.no_ffmpeg and shutil.which('ffmpeg') is None:
+        parser.error('ffmpeg not found in PATH; install it to compare against the encoder, or pass --no-ffmpeg')
+    main(args)
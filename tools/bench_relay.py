@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Memory / throughput benchmark for the multiplayer relay in server.py
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import server
+
+
+class FakeWS:
+    __slots__ = ('closed', 'frames', 'bytes')
+
+    def __init__(self):
+        self.closed = False
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_str(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def send_bytes(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+
+async def settle(*users):
+    # Wait for the backplane lookups started by join frames
+    while any(user.action == 'joining' for user in users):
+        await asyncio.sleep(0)
+
+
+async def make_room(gameid):
+    p1 = server.Connection(FakeWS())
+    p2 = server.Connection(FakeWS())
+    server.server_status['users'][p1.id] = p1
+    server.server_status['users'][p2.id] = p2
+    join = json.dumps({'type': 'join', 'value': {'id': gameid, 'diff': 'oni'}})
+    server.handle_frame(p1, join)
+    await settle(p1)
+    server.handle_frame(p2, join)
+    await settle(p2)
+    server.handle_frame(p1, '{"type":"gamestart"}')
+    server.handle_frame(p2, '{"type":"gamestart"}')
+    return p1, p2
+
+
+async def drain():
+    # Let every connection's writer empty its send queue
+    users = server.server_status['users'].values()
+    while any(user.writer is not None for user in users):
+        await asyncio.sleep(0)
+
+
+async def run(args):
+    await server.start_backplane(None)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    rooms = [await make_room('song%s' % i) for i in range(args.rooms)]
+    await drain()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    assert len(server.server_status['rooms']) == args.rooms
+    assert all(p1.action == 'playing' and p2.action == 'playing' for p1, p2 in rooms)
+    print('rooms:          %d' % args.rooms)
+    print('memory:         %.1f MiB (%d bytes/room)' % (used / 1048576, used // args.rooms))
+
+    note = json.dumps({'type': 'note', 'value': {'score': 450, 'ms': -12.5, 'dai': 2}})
+    start = time.perf_counter()
+    for i in range(args.frames):
+        for p1, p2 in rooms:
+            server.handle_frame(p1, note)
+            server.handle_frame(p2, note)
+        await drain()
+    elapsed = time.perf_counter() - start
+    total = args.frames * args.rooms * 2
+    print('frames relayed: %d' % total)
+    print('throughput:     %.0f frames/s (%.2f us/frame)' % (total / elapsed, elapsed / total * 1e6))
+
+    publisher = server.status_publisher
+    await asyncio.sleep(publisher.interval * 2)
+    print('status:         %d broadcasts, %d coalesced' % (publisher.broadcasts, publisher.coalesced))
+    print('slow consumers: %d dropped, %d kicked' % (server.send_stats['dropped'], server.send_stats['kicked']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the multiplayer relay.')
+    parser.add_argument('--rooms', type=int, default=10000, help='Concurrent rooms to create')
+    parser.add_argument('--frames', type=int, default=20, help='Note frames per player')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Compares the old one-update_one-per-score save loop with the scoredb.py storage
+# layouts (chunked bulk upserts, and one compact document per user) for a large
+# score import and the following load.
+# Needs a MongoDB server; everything is written to a scratch database that is dropped afterwards.
+# --check-sync also saves from several threads while a reader syncs the way /api/scores/get
+# does (read score_version, then load the scores saved since the last token), and exits with
+# an error if any saved score never reaches the reader.
+
+import argparse
+import base64
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+from pymongo import MongoClient, monitoring
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import scoredb
+
+
+class Commands(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def make_scores(count):
+    # Same shape as src/js/scorestorage.js: one "crown + base36 values" block per difficulty
+    scores = []
+    for i in range(count):
+        song_hash = base64.b64encode(os.urandom(16))[:-2].decode('utf-8')
+        diffs = []
+        for diff in range(5):
+            values = [random.randrange(1000000), random.randrange(1000), random.randrange(100), random.randrange(50), random.randrange(1000), random.randrange(200)]
+            diffs.append(str(random.randrange(3)) + ','.join(base36(x) for x in values))
+        scores.append({'hash': song_hash, 'score': ';'.join(diffs)})
+    return scores
+
+
+def base36(value):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        value, digit = divmod(value, 36)
+        out = digits[digit] + out
+        if not value:
+            return out
+
+
+def save_loop(db, username, scores):
+    # What route_api_scores_save() used to do
+    db.scores.delete_many({'username': username})
+    for score in scores:
+        db.scores.update_one({'username': username, 'hash': score['hash']},
+                             {'$set': {'username': username, 'hash': score['hash'], 'score': score['score']}}, upsert=True)
+
+
+def measure(name, save, load, commands, scores):
+    start_commands = commands.count
+    tracemalloc.start()
+    start = time.perf_counter()
+    save('bench', scores)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    save_commands = commands.count - start_commands
+
+    start_commands = commands.count
+    start = time.perf_counter()
+    stored = len(load('bench'))
+    load_elapsed = time.perf_counter() - start
+    print('%-10s save %8.2f s %10.0f scores/s %8d round trips %8.1f KiB peak | load %7.1f ms %4d round trips (%d stored)' % (
+        name, elapsed, len(scores) / elapsed, save_commands, peak / 1024,
+        load_elapsed * 1000, commands.count - start_commands, stored))
+
+
+def check_sync(name, db, store, args):
+    db.users.delete_many({'username': 'sync'})
+    db.users.insert_one({'username': 'sync', 'score_version': 0})
+    synced = set()
+    token = 0
+    done = threading.Event()
+
+    def sync():
+        nonlocal token
+        version = db.users.find_one({'username': 'sync'})['score_version']
+        for score in store.load('sync', token):
+            synced.add(score['hash'])
+        token = version
+
+    def save():
+        for i in range(args.check_saves):
+            store.save('sync', make_scores(3))
+
+    writers = [threading.Thread(target=save) for i in range(args.check_writers)]
+    for writer in writers:
+        writer.start()
+    reads = 0
+    while any(writer.is_alive() for writer in writers):
+        sync()
+        reads += 1
+    for writer in writers:
+        writer.join()
+    sync()
+    stored = set(score['hash'] for score in store.load('sync'))
+    missed = len(stored - synced)
+    print('%-10s sync check: %d saves from %d threads, %d reads, %d of %d scores missed' % (
+        name, args.check_saves * args.check_writers, args.check_writers, reads, missed, len(stored)))
+    return missed
+
+
+def main(args):
+    commands = Commands()
+    client = MongoClient(args.mongo, event_listeners=[commands])
+    db = client[args.database]
+    client.drop_database(args.database)
+    documents = scoredb.DocumentScores(db)
+    compact = scoredb.CompactScores(db)
+    documents.create_indexes()
+    compact.create_indexes()
+    scores = make_scores(args.scores)
+    print('%d scores, %d per write' % (len(scores), scoredb.CHUNK_SIZE))
+    try:
+        if not args.skip_loop:
+            measure('loop', lambda username, scores: save_loop(db, username, scores), documents.load, commands, scores)
+        measure('documents', lambda username, scores: documents.save(username, scores, replace=True), documents.load, commands, scores)
+        measure('compact', lambda username, scores: compact.save(username, scores, replace=True), compact.load, commands, scores)
+        if args.check_sync:
+            missed = check_sync('documents', db, documents, args) + check_sync('compact', db, compact, args)
+            if missed:
+                raise SystemExit(1)
+    finally:
+        client.drop_database(args.database)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark score imports against MongoDB.')
+    parser.add_argument('--mongo', default='mongodb://localhost:27017', help='MongoDB URI')
+    parser.add_argument('--database', default='taiko_bench_scores', help='Scratch database (dropped afterwards)')
+    parser.add_argument('--scores', type=int, default=10000, help='Scores to import')
+    parser.add_argument('--skip-loop', action='store_true', help='Skip the old per-score loop')
+    parser.add_argument('--check-sync', action='store_true', help='Also check that saves interleaved with syncs lose nothing')
+    parser.add_argument('--check-writers', type=int, default=4, help='Saving threads for --check-sync')
+    parser.add_argument('--check-saves', type=int, default=200, help='Saves per thread for --check-sync')
+    main(parser.parse_args())
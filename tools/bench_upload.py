@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Uploads generated songs to /api/upload of a running instance and reports, per upload,
+# the time taken and the server's resident memory (sampled from /proc/<pid>/status).
+# With the streaming upload path the server RSS should stay flat as --size grows.
+# Every upload adds a song to the catalog; remove them with /api/delete afterwards.
+# --disconnect also sends uploads that are cut off halfway and, with --tmp-dir, checks
+# that the server removed their partial files.
+
+import argparse
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+TJA = '''TITLE:bench_upload {index}
+SUBTITLE:--
+BPM:120
+WAVE:main.mp3
+OFFSET:0
+DEMOSTART:0
+
+COURSE:Oni
+LEVEL:1
+
+#START
+1010101010101010,
+#END
+'''
+
+
+def read_rss(pid):
+    with open('/proc/%s/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class Sampler(threading.Thread):
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+
+    def reset(self):
+        self.peak = read_rss(self.pid)
+
+    def run(self):
+        while not self.stop.is_set():
+            self.peak = max(self.peak, read_rss(self.pid))
+            time.sleep(self.interval)
+
+
+def main(args):
+    sampler = None
+    if args.pid:
+        sampler = Sampler(args.pid, args.interval)
+        sampler.reset()
+        sampler.start()
+        print('server RSS before: %.1f MiB' % (read_rss(args.pid) / 1048576))
+
+    size = int(args.size * 1048576)
+    print('%5s %10s %10s %12s %12s %s' % ('#', 'MiB', 'seconds', 'MiB/s', 'peak MiB', 'result'))
+    for i in range(args.count):
+        tja = TJA.format(index='%s-%s' % (os.getpid(), i)).encode('utf-8')
+        # Random bytes so every upload gets a new id
+        music = os.urandom(size)
+        if sampler:
+            sampler.reset()
+        start = time.perf_counter()
+        response = requests.post('%s/api/upload' % args.site, files={
+            'file_tja': ('main.tja', tja),
+            'file_music': ('main.mp3', music)
+        })
+        elapsed = time.perf_counter() - start
+        try:
+            result = response.json()
+        except ValueError:
+            result = response.status_code
+        if isinstance(result, dict) and 'error' in result:
+            result = 'error: %s' % result['error'].strip().splitlines()[-1]
+        peak = '%12.1f' % (sampler.peak / 1048576) if sampler else '%12s' % '-'
+        print('%5d %10.1f %10.2f %12.1f %s %s' % (
+            i + 1, size / 1048576, elapsed, size / 1048576 / elapsed, peak, result))
+        del music
+
+    if sampler:
+        sampler.stop.set()
+
+    if args.disconnect:
+        for i in range(args.disconnect):
+            disconnect(args.site, size)
+        # Give the server time to notice the closed sockets
+        time.sleep(1)
+        print('%d uploads cut off halfway' % args.disconnect)
+        if args.tmp_dir:
+            left = [name for name in os.listdir(args.tmp_dir) if name.startswith('.upload-')] if os.path.isdir(args.tmp_dir) else []
+            print('partial files left in %s: %d' % (args.tmp_dir, len(left)))
+            if left:
+                raise SystemExit(1)
+
+
+def disconnect(site, size):
+    # Announces the full body in Content-Length but closes the socket after sending half of the music file
+    url = urlsplit(site)
+    boundary = 'bench%s' % os.getpid()
+    head = ('--{0}\r\nContent-Disposition: form-data; name="file_tja"; filename="main.tja"\r\n\r\n'
+            '{1}\r\n--{0}\r\nContent-Disposition: form-data; name="file_music"; filename="main.mp3"\r\n\r\n').format(
+        boundary, TJA.format(index='disconnect')).encode('utf-8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+    request = ('POST /api/upload HTTP/1.1\r\nHost: %s\r\nContent-Type: multipart/form-data; boundary=%s\r\n'
+               'Content-Length: %d\r\n\r\n' % (url.netloc, boundary, len(head) + size + len(tail))).encode('utf-8')
+    sock = socket.create_connection((url.hostname, url.port or 80))
+    try:
+        sock.sendall(request + head + os.urandom(size // 2))
+        time.sleep(0.2)
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark song uploads.')
+    parser.add_argument('site', help='Instance URL, eg. http://localhost:34801')
+    parser.add_argument('--size', type=float, default=20, help='Music file size in MiB')
+    parser.add_argument('--count', type=int, default=5, help='Uploads to make')
+    parser.add_argument('--pid', type=int, help='PID of the server worker, to sample its RSS')
+    parser.add_argument('--interval', type=float, default=0.01, help='RSS sampling interval in seconds')
+    parser.add_argument('--disconnect', type=int, default=0, help='Uploads to cut off halfway after the timed ones')
+    parser.add_argument('--tmp-dir', help='Server upload temp directory (TAIKO_WEB_UPLOAD_TMP_DIR) to check for partial files')
+    main(parser.parse_args())
@@ -1,38 +1,124 @@
 #!/usr/bin/env python3
-# .ogg preview generator for use when app and songs are on two different machines
+# Preview generator for use when app and songs are on two different machines.
+# Encodes songs in parallel and keeps a manifest of what each preview was made from,
+# so later runs only re-encode songs whose audio, preview offset or codec settings changed.
 
 import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import os.path
-from ffmpy import FFmpeg
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import previews
 
-parser = argparse.ArgumentParser(description='Generate song previews.')
-parser.add_argument('site', help='Instance URL, eg. https://taiko.bui.pm')
-parser.add_argument('song_dir', help='Path to songs directory, eg. /srv/taiko/public/taiko/songs')
-parser.add_argument('--overwrite', action='store_true', help='Overwrite existing previews')
-args = parser.parse_args()
 
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def plan(songs, args, manifest):
+    # (song, ext, song_path, prev_path, manifest key, manifest entry) for every preview that needs encoding
+    jobs = []
+    skipped = 0
+    missing = 0
+    for song in songs:
+        if not song.get('preview') or song['preview'] <= 0:
+            skipped += 1
+            continue
+        song_dir = os.path.join(args.song_dir, str(song['id']))
+        song_path = os.path.join(song_dir, 'main.%s' % (song.get('music_type') or 'mp3'))
+        try:
+            stat = os.stat(song_path)
+        except OSError:
+            missing += 1
+            continue
+        for ext in args.formats:
+            prev_path = os.path.join(song_dir, 'preview.%s' % ext)
+            entry = [stat.st_size, int(stat.st_mtime), song['preview'], previews.CODECS[ext]]
+            key = '%s/%s' % (song['id'], ext)
+            if not args.overwrite and manifest.get(key) == entry and os.path.isfile(prev_path):
+                skipped += 1
+                continue
+            jobs.append((song, ext, song_path, prev_path, key, entry))
+    return jobs, skipped, missing
 
-if __name__ == '__main__':
-    songs = requests.get('{}/api/songs'.format(args.site)).json()
-    for i, song in enumerate(songs):
-        print('{}/{} {} (id: {})'.format(i + 1, len(songs), song['title'], song['id']))
 
-        song_path = '{}/{}/main.{}'.format(args.song_dir, song['id'], song['music_type'] if 'music_type' in song else 'mp3')
-        prev_path = '{}/{}/preview.ogg'.format(args.song_dir, song['id'])
+def encode(job):
+    song, ext, song_path, prev_path, key, entry = job
+    start = time.perf_counter()
+    # The old preview stays in place until the new one is renamed over it
+    made = previews.make_preview(song_path, prev_path, song['preview'], ext)
+    return job, made, time.perf_counter() - start
 
-        if os.path.isfile(song_path):
-            if not os.path.isfile(prev_path) or args.overwrite:
-                if not song['preview'] or song['preview'] <= 0:
-                    print('Skipping due to no preview')
+
+def main(args):
+    manifest_path = args.manifest or os.path.join(args.song_dir, 'previews.json')
+    manifest = load_manifest(manifest_path)
+    songs = requests.get('{}/api/songs'.format(args.site)).json()
+    jobs, skipped, missing = plan(songs, args, manifest)
+    print('{} songs: {} previews to make, {} up to date or without preview, {} without audio ({} jobs)'.format(
+        len(songs), len(jobs), skipped, missing, args.jobs))
+
+    made = 0
+    failed = 0
+    source_bytes = 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(encode, job) for job in jobs]
+            for i, future in enumerate(futures):
+                job = jobs[i]
+                song, ext = job[0], job[1]
+                try:
+                    job, done, elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    print('{}/{} {} (id: {}) preview.{} failed: {}'.format(i + 1, len(jobs), song['title'], song['id'], ext, e))
                     continue
+                if done:
+                    made += 1
+                    source_bytes += job[5][0]
+                    manifest[job[4]] = job[5]
+                    print('{}/{} {} (id: {}) preview.{} {:.1f}s'.format(i + 1, len(jobs), song['title'], song['id'], ext, elapsed))
+                    if made % 50 == 0:
+                        save_manifest(manifest_path, manifest)
+                else:
+                    print('{}/{} {} (id: {}) preview.{} is being made by another process'.format(i + 1, len(jobs), song['title'], song['id'], ext))
+    finally:
+        save_manifest(manifest_path, manifest)
 
-                print('Making preview.ogg')
-                ff = FFmpeg(inputs={song_path: '-ss %s' % song['preview']},
-                            outputs={prev_path: '-codec:a libvorbis -b:a 64k -ar 32000 -y -loglevel panic'})
-                ff.run()
-            else:
-                print('Preview already exists')
-        else:
-            print('song file not found')
+    elapsed = time.perf_counter() - start
+    print('Made {} previews ({} failed) in {:.1f}s: {:.2f} previews/s, {:.1f} MiB of audio/s'.format(
+        made, failed, elapsed, made / elapsed if elapsed else 0, source_bytes / 1048576 / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate song previews.')
+    parser.add_argument('site', help='Instance URL, eg. https://taiko.bui.pm')
+    parser.add_argument('song_dir', help='Path to songs directory, eg. /srv/taiko/public/taiko/songs')
+    parser.add_argument('--overwrite', action='store_true', help='Re-encode every preview, ignoring the manifest')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='ffmpeg processes to run at once')
+    parser.add_argument('--formats', type=lambda s: s.split(','), default=['mp3', 'ogg'],
+                        help='Comma separated preview formats to make (PREVIEW_TYPE is mp3 or ogg)')
+    parser.add_argument('--manifest', help='Manifest file (default: <song_dir>/previews.json)')
+    args = parser.parse_args()
+    for ext in args.formats:
+        if ext not in previews.CODECS:
+            parser.error('unknown preview format: {}'.format(ext))
+    main(args)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# WebSocket load generator for the multiplayer server (server.py).
+# Spins up N synthetic pairs that replay a p2.js session:
+#   join -> gameload -> gamestart -> note stream -> gameresults -> gameend
+# and reports relay latency, frames per second, the server's event-loop lag (scraped from
+# its /metrics histogram) and server RSS. Client-side lag numbers are labelled as such.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+NOTE_FRAME = struct.Struct('>BhfB')
+LAG_METRIC = 'taiko_event_loop_lag_seconds'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def parse_lag(text):
+    # Cumulative bucket counts, sum and count of the server's loop-lag histogram
+    lag = {'buckets': {}, 'sum': 0.0, 'count': 0, 'blocked': 0}
+    for line in text.splitlines():
+        if line.startswith(LAG_METRIC + '_bucket{le="'):
+            bound, count = line[len(LAG_METRIC) + 12:].split('"} ')
+            lag['buckets'][float(bound)] = int(count)
+        elif line.startswith(LAG_METRIC + '_sum '):
+            lag['sum'] = float(line.split()[1])
+        elif line.startswith(LAG_METRIC + '_count '):
+            lag['count'] = int(line.split()[1])
+        elif line.startswith('taiko_event_loop_blocked_total '):
+            lag['blocked'] = int(line.split()[1])
+    return lag
+
+
+def lag_report(before, after):
+    # Loop lag during the run only. Percentiles are bucket upper bounds
+    count = after['count'] - before['count']
+    if not count:
+        return None
+    buckets = sorted((bound, total - before['buckets'].get(bound, 0)) for bound, total in after['buckets'].items())
+    report = {'samples': count, 'mean': (after['sum'] - before['sum']) / count * 1000,
+              'blocked': after['blocked'] - before['blocked']}
+    for p in (50, 99):
+        report['p%d' % p] = next(bound for bound, total in buckets if total >= count * p / 100) * 1000
+    return report
+
+
+async def scrape_lag(url):
+    metrics_url = url.replace('ws://', 'http://').replace('wss://', 'https://').rsplit('/', 1)[0] + '/metrics'
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(metrics_url) as resp:
+                if resp.status != 200:
+                    return None
+                return parse_lag(await resp.text())
+    except aiohttp.ClientError:
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.loop_lag = []
+        self.healthcheck = []
+        self.rss = []
+        self.errors = 0
+        self.games = 0
+
+
+class Player:
+    def __init__(self, ws, stats, binary):
+        self.ws = ws
+        self.stats = stats
+        self.binary = binary
+        self.peer = None
+        self.waiters = {}
+        # sequence number -> send time, for binary frames that cannot carry a timestamp
+        self.sent = {}
+
+    def expect(self, msg_type):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[msg_type] = future
+        return future
+
+    async def reader(self):
+        stats = self.stats
+        async for msg in self.ws:
+            now = time.perf_counter()
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                seq = NOTE_FRAME.unpack(msg.data)[1]
+                start = self.peer.sent.pop(seq, None)
+                if start is not None:
+                    stats.latencies.append(now - start)
+                stats.received += 1
+                continue
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                break
+            data = json.loads(msg.data)
+            if data.get('type') == 'note':
+                stats.latencies.append(now - data['value']['t'])
+                stats.received += 1
+            future = self.waiters.pop(data.get('type'), None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    async def send(self, msg_type, value=None):
+        if value is None:
+            await self.ws.send_str(json.dumps({'type': msg_type}, separators=(',', ':')))
+        else:
+            await self.ws.send_str(json.dumps({'type': msg_type, 'value': value}, separators=(',', ':')))
+
+    async def stream(self, rate, duration):
+        # Note frames at `rate` per second, like src/js/game.js sends on each hit
+        interval = 1 / rate
+        end = time.perf_counter() + duration
+        next_send = time.perf_counter() + random.random() * interval
+        seq = 0
+        while True:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if self.binary:
+                seq = (seq + 1) % 32768
+                self.sent[seq] = now
+                await self.ws.send_bytes(NOTE_FRAME.pack(1, seq, -12.5, 8 | 1))
+            else:
+                await self.send('note', {'score': 450, 'ms': -12.5, 'dai': 1, 't': now})
+            self.stats.sent += 1
+            next_send += interval
+
+
+async def connect(session, url, stats, binary):
+    protocols = ('taiko-bin',) if binary else ()
+    ws = await session.ws_connect(url, protocols=protocols, max_msg_size=0)
+    player = Player(ws, stats, binary and ws.protocol == 'taiko-bin')
+    task = asyncio.ensure_future(player.reader())
+    return player, task
+
+
+async def play_pair(index, session, args, stats, start_gate):
+    p1, t1 = await connect(session, args.url, stats, args.binary)
+    p2, t2 = await connect(session, args.url, stats, args.binary)
+    p1.peer = p2
+    p2.peer = p1
+    try:
+        gameid = 'loadtest-%s-%s' % (os.getpid(), index)
+        waiting = p1.expect('waiting')
+        await p1.send('join', {'id': gameid, 'diff': 'oni', 'name': 'p1-%s' % index})
+        await asyncio.wait_for(waiting, args.timeout)
+
+        loads = [p1.expect('gameload'), p2.expect('gameload')]
+        await p2.send('join', {'id': gameid, 'diff': 'oni', 'name': 'p2-%s' % index})
+        await asyncio.wait_for(asyncio.gather(*loads), args.timeout)
+
+        await start_gate.wait()
+        starts = [p1.expect('gamestart'), p2.expect('gamestart')]
+        await p1.send('gamestart')
+        await p2.send('gamestart')
+        await asyncio.wait_for(asyncio.gather(*starts), args.timeout)
+
+        await asyncio.gather(p1.stream(args.rate, args.duration), p2.stream(args.rate, args.duration))
+
+        results = {'points': 1000000, 'good': 800, 'ok': 10, 'bad': 2, 'maxCombo': 800, 'drumroll': 30}
+        await p1.send('gameresults', results)
+        await p2.send('gameresults', results)
+        ends = [p1.expect('gameend'), p2.expect('gameend')]
+        await p1.send('gameend')
+        await asyncio.wait_for(asyncio.gather(*ends), args.timeout)
+        stats.games += 1
+    except (asyncio.TimeoutError, aiohttp.ClientError, ConnectionError):
+        stats.errors += 1
+    finally:
+        await p1.ws.close()
+        await p2.ws.close()
+        t1.cancel()
+        t2.cancel()
+
+
+async def monitor(args, stats, server_pid, stop):
+    # Client-side samples (this process's loop lag, /healthcheck round trip) and server RSS.
+    # The server's own loop lag comes from /metrics, see scrape_lag()
+    http_url = args.url.replace('ws://', 'http://').replace('wss://', 'https://').rsplit('/', 1)[0] + '/healthcheck'
+    async with aiohttp.ClientSession() as session:
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(args.sample)
+            stats.loop_lag.append(time.perf_counter() - start - args.sample)
+            try:
+                start = time.perf_counter()
+                async with session.get(http_url) as resp:
+                    await resp.read()
+                stats.healthcheck.append(time.perf_counter() - start)
+            except aiohttp.ClientError:
+                pass
+            if server_pid:
+                try:
+                    with open('/proc/%s/status' % server_pid) as f:
+                        for line in f:
+                            if line.startswith('VmRSS:'):
+                                stats.rss.append(int(line.split()[1]) * 1024)
+                except OSError:
+                    pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def spawn_server():
+    port = free_port()
+    env = dict(os.environ, PORT=str(port))
+    proc = subprocess.Popen([sys.executable, 'server.py'], cwd=parent_dir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    async with aiohttp.ClientSession() as session:
+        for i in range(100):
+            try:
+                async with session.get('http://127.0.0.1:%s/healthcheck' % port) as resp:
+                    if resp.status == 200:
+                        return proc, 'ws://127.0.0.1:%s/p2' % port
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('server.py did not start')
+
+
+async def run(args):
+    proc = None
+    if not args.url:
+        proc, args.url = await spawn_server()
+    stats = Stats()
+    stop = asyncio.Event()
+    start_gate = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        lag_before = await scrape_lag(args.url)
+        monitor_task = asyncio.ensure_future(monitor(args, stats, proc.pid if proc else args.pid, stop))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            pairs = []
+            for i in range(args.pairs):
+                pairs.append(asyncio.ensure_future(play_pair(i, session, args, stats, start_gate)))
+                if args.ramp:
+                    await asyncio.sleep(args.ramp / args.pairs)
+            start_gate.set()
+            start = time.perf_counter()
+            await asyncio.gather(*pairs)
+            elapsed = time.perf_counter() - start
+        lag_after = await scrape_lag(args.url)
+        stop.set()
+        await monitor_task
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        'pairs': args.pairs,
+        'games': stats.games,
+        'errors': stats.errors,
+        'frames_sent': stats.sent,
+        'frames_relayed': stats.received,
+        'frames_per_second': stats.received / elapsed if elapsed else 0,
+        'latency_ms': {p: percentile(stats.latencies, p) * 1000 for p in (50, 95, 99)},
+        'server_loop_lag_ms': lag_report(lag_before, lag_after) if lag_before and lag_after else None,
+        'client_loop_lag_ms': {p: percentile(stats.loop_lag, p) * 1000 for p in (50, 99)},
+        'client_healthcheck_rtt_ms': {p: percentile(stats.healthcheck, p) * 1000 for p in (50, 99)},
+        'server_rss_mib': max(stats.rss) / 1048576 if stats.rss else None
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('pairs:            %d (%d games, %d errors)' % (args.pairs, stats.games, stats.errors))
+        print('frames:           %d sent, %d relayed, %.0f/s' % (stats.sent, stats.received, report['frames_per_second']))
+        print('relay latency:    p50 %.2f ms  p95 %.2f ms  p99 %.2f ms' % tuple(report['latency_ms'][p] for p in (50, 95, 99)))
+        lag = report['server_loop_lag_ms']
+        if lag is not None:
+            print('server loop lag:  mean %.2f ms  p50 <= %g ms  p99 <= %g ms  (%d samples, %d blocked)' % (
+                lag['mean'], lag['p50'], lag['p99'], lag['samples'], lag['blocked']))
+        else:
+            print('server loop lag:  unavailable (no /metrics)')
+        print('client-side loop lag:         p50 %.2f ms  p99 %.2f ms' % tuple(report['client_loop_lag_ms'][p] for p in (50, 99)))
+        print('client-side /healthcheck RTT: p50 %.2f ms  p99 %.2f ms' % tuple(report['client_healthcheck_rtt_ms'][p] for p in (50, 99)))
+        if report['server_rss_mib'] is not None:
+            print('server RSS:       %.1f MiB peak' % report['server_rss_mib'])
+
+    failed = stats.errors > 0
+    if args.max_p99 is not None and report['latency_ms'][99] > args.max_p99:
+        print('FAIL: p99 latency %.2f ms exceeds %.2f ms' % (report['latency_ms'][99], args.max_p99), file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the multiplayer WebSocket server.')
+    parser.add_argument('--url', help='WebSocket URL, eg. ws://127.0.0.1:8080/p2 (default: spawn server.py on a free port)')
+    parser.add_argument('--pid', type=int, help='PID of an already running server, to sample its RSS')
+    parser.add_argument('--pairs', type=int, default=100, help='Concurrent player pairs')
+    parser.add_argument('--rate', type=float, default=8, help='Notes per second per player')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of note stream per game')
+    parser.add_argument('--ramp', type=float, default=2, help='Seconds over which pairs connect')
+    parser.add_argument('--binary', action='store_true', help='Negotiate binary note frames')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for each handshake step')
+    parser.add_argument('--sample', type=float, default=0.1, help='Seconds between client-side lag / RSS samples')
+    parser.add_argument('--max-p99', type=float, help='Exit with status 1 if p99 relay latency (ms) exceeds this')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    sys.exit(asyncio.run(run(parser.parse_args())))
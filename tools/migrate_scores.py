@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Converts stored scores between the SCORE_STORAGE layouts in scoredb.py:
+#   documents -> compact: one user_scores document per user built from the scores collection
+#   compact -> documents: the reverse, for rolling back
+# The source collection is left untouched unless --drop-source is given.
+# --dedupe only removes duplicate (username, hash) scores left by older versions, keeping the
+# newest of each, and builds the unique index that app.py could not create while they existed.
+
+import argparse
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+import config
+import scoredb
+
+
+def user_scores(db, to):
+    # Yields (username, [{'hash', 'score'}]) one user at a time, so memory holds a single user's scores
+    if to == 'compact':
+        username = None
+        scores = []
+        # Sorted on the (username, hash) index, so users arrive contiguous
+        for doc in db.scores.find({}, {'_id': False, 'username': True, 'hash': True, 'score': True}).sort([('username', 1), ('hash', 1)]):
+            if doc['username'] != username:
+                if scores:
+                    yield username, scores
+                username = doc['username']
+                scores = []
+            scores.append({'hash': doc['hash'], 'score': doc['score']})
+        if scores:
+            yield username, scores
+    else:
+        source = scoredb.CompactScores(db)
+        for doc in db.user_scores.find({}, {'_id': True}):
+            yield doc['_id'], source.load(doc['_id'])
+
+
+def main(args):
+    client = MongoClient(os.environ.get('TAIKO_WEB_MONGO_HOST') or config.MONGO['host'])
+    db = client[config.MONGO['database']]
+    if args.dedupe:
+        store = scoredb.DocumentScores(db)
+        removed = store.dedupe()
+        # Replaces the non-unique index app.py falls back to
+        index = db.scores.index_information().get('username_1_hash_1')
+        if index and not index.get('unique'):
+            db.scores.drop_index('username_1_hash_1')
+        store.create_indexes()
+        print('Removed %d duplicate scores' % removed)
+        return
+
+    target = scoredb.create_store(db, args.to)
+    target.create_indexes()
+
+    users = 0
+    scores = 0
+    start = time.perf_counter()
+    for username, entries in user_scores(db, args.to):
+        scores += target.save(username, entries, replace=True)
+        users += 1
+        if users % 1000 == 0:
+            print('%d users, %d scores' % (users, scores))
+    elapsed = time.perf_counter() - start
+    print('Migrated %d scores of %d users to %s in %.1f s' % (scores, users, args.to, elapsed))
+
+    if args.drop_source:
+        if args.to == 'compact':
+            db.scores.drop()
+        else:
+            db.user_scores.drop()
+        print('Dropped the source collection')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert scores between the documents and compact storage layouts.')
+    parser.add_argument('--to', choices=['compact', 'documents'], default='compact', help='Layout to convert to')
+    parser.add_argument('--drop-source', action='store_true', help='Drop the old collection afterwards')
+    parser.add_argument('--dedupe', action='store_true', help='Remove duplicate scores in the documents layout and exit')
+    main(parser.parse_args())
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# Prints a multiplayer recording (TAIKO_WEB_RECORD_DIR/*.tkr) one frame per line,
+# reading it through mmap so long recordings are streamed rather than loaded.
+
+import argparse
+import json
+import mmap
+import os
+import sys
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(current_dir))
+from recording import read_header, iter_records
+from server import replay_frame
+
+
+def main(args):
+    with open(args.path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with buf:
+        header, pos = read_header(buf)
+        print(json.dumps(header, ensure_ascii=False))
+        frames = 0
+        for ms, player, kind, payload in iter_records(buf, pos):
+            frame = replay_frame(kind, payload)
+            frames += 1
+            if args.player is not None and player != args.player:
+                continue
+            print('%8d ms  P%d  %s' % (ms, player, frame))
+        print('%d frames, %d bytes (%.1f bytes/frame)' % (frames, len(buf), len(buf) / frames if frames else 0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print a recorded multiplayer game.')
+    parser.add_argument('path', help='Recording file (.tkr)')
+    parser.add_argument('--player', type=int, help='Only show frames from this player (0 = room events)')
+    main(parser.parse_args())